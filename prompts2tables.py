@@ -1,16 +1,20 @@
+import argparse
+import asyncio
+import hashlib
+import importlib.util
+import io
 import logging
 import os
 import sys
 import re
 import csv
+import json
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from google import genai
-from google.genai import types
-from dotenv import load_dotenv
-import inquirer
+from typing_extensions import TypedDict
 
-# Load environment variables
-load_dotenv()
+# google.genai, inquirer and dotenv are imported where they are used so
+# that --help and scripted runs do not pay for them at startup
 
 # Configure logging
 logging.basicConfig(
@@ -19,8 +23,45 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Gemini generation settings (also part of the response cache key)
+GEMINI_MODEL = 'gemini-2.5-pro'  # Using a generally available and capable model
+TEMPERATURE = 0.5  # lower (0.1) for consistent formatting
+MAX_OUTPUT_TOKENS = 32000
+
+# Maximum number of Gemini requests allowed in flight at once
+MAX_CONCURRENT_REQUESTS = 8
+
+# Maximum number of threads used to read prompt files concurrently
+MAX_READ_WORKERS = 16
+
+# Splits text into digit and non-digit runs for natural sorting
+NATURAL_SORT_PATTERN = re.compile(r'(\d+)')
+
+# Column names of the generated CSV tables
+CSV_FIELDNAMES = ('scene', 'shot', 'prompt')
+
+# Matches the "| Scene |" header that starts a markdown table
+MARKDOWN_HEADER_PATTERN = re.compile(
+    r'^\s*\|\s*Scene\s*\|', re.IGNORECASE | re.MULTILINE)
+# Matches one "| scene | shot | prompt |" markdown table row per line
+MARKDOWN_ROW_PATTERN = re.compile(
+    r'^\s*\|([^|\n]*)\|([^|\n]*)\|([^|\n]*)\|\s*$', re.MULTILINE)
+MARKDOWN_SEPARATOR_PATTERN = re.compile(r':?-+:?')
+
+# Adaptive batching budgets. Tokens are estimated at ~4 characters each and
+# every prompt found in the input is assumed to cost ~300 output tokens.
+INPUT_TOKEN_BUDGET = 200000
+OUTPUT_TOKEN_BUDGET = 30000
+OUTPUT_TOKENS_PER_PROMPT = 300
+
+# Matches the "Prompt:" label in front of each image prompt
+PROMPT_LABEL_PATTERN = re.compile(r'prompt\s*:', re.IGNORECASE)
+
+# Cached Gemini responses live here unless STORYBOARD_GEN_CACHE_DIR is set
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "storyboard_gen"
+
 # System prompt for parsing image prompts into structured format
-SYSTEM_PROMPT = """You are a data extraction specialist. Your task is to parse image prompt files and extract the scene, shot, and prompt information into a structured markdown table format.
+SYSTEM_PROMPT = """You are a data extraction specialist. Your task is to parse image prompt files and extract the scene, shot, and prompt information into structured rows.
 
 The input will contain multiple image prompt files concatenated together. Each file may have slightly different formatting, but generally follows patterns like:
 
@@ -31,41 +72,71 @@ The input will contain multiple image prompt files concatenated together. Each f
 Your task is to:
 1. Identify all scenes, shots, and their corresponding image prompts
 2. Extract the scene number/identifier, shot identifier, and the full prompt text
-3. Output ONLY a clean markdown table with three columns: Scene, Shot, Prompt
+3. Output one row per prompt with the fields scene, shot and prompt
 
-The output format should be:
-| Scene | Shot | Prompt |
-|-------|------|--------|
-| 1 | 1A | [full prompt text] |
-| 1 | 1B | [full prompt text] |
-| 2 | 2A | [full prompt text] |
+Example rows:
+{"scene": "1", "shot": "1A", "prompt": "[full prompt text]"}
+{"scene": "1", "shot": "1B", "prompt": "[full prompt text]"}
+{"scene": "2", "shot": "2A", "prompt": "[full prompt text]"}
 
 Requirements:
 - Include ALL prompts found in the input
 - Keep the full prompt text intact (don't truncate)
 - Use consistent scene and shot identifiers
-- Don't include any other text or explanations, just the markdown table
 - If a prompt spans multiple lines, keep it as one entry
 - Remove any markdown formatting from within the prompt text itself (like **bold** text)
 """
 
 
+class GeminiParseError(RuntimeError):
+    """Raised when Gemini fails to return structured rows for the input"""
+
+
+class Row(TypedDict):
+    """One extracted prompt, as returned by Gemini and written to CSV"""
+    scene: str
+    shot: str
+    prompt: str
+
+
 def create_gemini_client(api_key):
-    """Create and return a Gemini API client"""
-    return genai.Client(api_key=api_key)
+    """Create and return a Gemini API client.
+
+    A single client is created per run and shared by every request. Its
+    httpx connection pool is sized for MAX_CONCURRENT_REQUESTS, and HTTP/2
+    is used when the optional h2 package is installed so concurrent
+    requests can share one TLS connection.
+    """
+    import httpx
+    from google import genai
+    from google.genai import types
+
+    client_args = {
+        'http2': importlib.util.find_spec('h2') is not None,
+        'limits': httpx.Limits(
+            max_connections=MAX_CONCURRENT_REQUESTS * 4,
+            max_keepalive_connections=MAX_CONCURRENT_REQUESTS * 4,
+        ),
+    }
+    http_options = types.HttpOptions(client_args=client_args)
+    # With aiohttp installed the SDK passes async_client_args to aiohttp,
+    # which does not accept httpx options, so only set them for httpx
+    if importlib.util.find_spec('aiohttp') is None:
+        http_options.async_client_args = client_args
+
+    return genai.Client(api_key=api_key, http_options=http_options)
 
 
 def read_prompt_file(file_path):
     """Read a prompt file and return its content"""
     try:
-        with open(file_path, 'r', encoding='utf-8', errors='ignore') as file:
-            content = file.read().strip()
+        content = Path(file_path).read_text(encoding='utf-8', errors='ignore').strip()
 
         if not content:
-            logger.warning(f"File appears to be empty: {file_path}")
+            logger.warning("File appears to be empty: %s", file_path)
             return ""
 
-        logger.info(f"Successfully read prompt file: {file_path}")
+        logger.info("Successfully read prompt file: %s", file_path)
         return content
 
     except Exception as e:
@@ -73,48 +144,85 @@ def read_prompt_file(file_path):
         return ""
 
 
-def concatenate_prompt_files(prompt_file_paths):
-    """Concatenate multiple prompt files into one large text"""
-    if not prompt_file_paths:
-        logger.error("No prompt files provided for concatenation")
+def label_prompt_content(file_path, content):
+    """Prefix prompt file content with its FILE separator line"""
+    return f"=== FILE: {file_path.name} ===\n{content}\n\n"
+
+
+def read_labelled_prompt_file(file_path):
+    """Read a prompt file and prefix it with its FILE separator line"""
+    file_content = read_prompt_file(file_path)
+    if not file_content:
         return ""
+    return label_prompt_content(file_path, file_content)
 
-    # Sort files using natural sorting for consistent order
-    sorted_prompt_files = sorted(
-        prompt_file_paths, key=lambda x: natural_sort_key(x.name))
 
-    logger.info("Concatenating prompt files in this order:")
-    for i, file_path in enumerate(sorted_prompt_files, 1):
-        logger.info(f"  {i}. {file_path.name}")
+def read_prompt_files(file_paths):
+    """Read several prompt files concurrently, returning their contents in order"""
+    if not file_paths:
+        return []
+    max_workers = min(MAX_READ_WORKERS, len(file_paths))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(read_prompt_file, file_paths))
 
-    combined_content = []
-    successful_files = 0
 
-    for prompt_file_path in sorted_prompt_files:
-        if not prompt_file_path.exists():
-            logger.warning(f"Prompt file not found: {prompt_file_path}")
-            continue
+def group_duplicate_prompt_files(file_paths, contents):
+    """Group files with identical content so each distinct text is sent once.
+
+    Empty contents are skipped. Groups keep the order in which each
+    distinct content was first seen.
 
-        if prompt_file_path.suffix.lower() != '.txt':
-            logger.warning(f"Skipping non-txt file: {prompt_file_path}")
+    Returns:
+        list: A list of (content, [paths]) tuples.
+    """
+    groups = {}
+    for file_path, content in zip(file_paths, contents):
+        if not content:
+            logger.warning("No content read from: %s", file_path)
             continue
 
-        # Read prompt file content
-        file_content = read_prompt_file(prompt_file_path)
-        if file_content:
-            # Add file separator and content
-            combined_content.append(f"=== FILE: {prompt_file_path.name} ===")
-            combined_content.append(file_content)
-            combined_content.append("")  # Add blank line between files
-            successful_files += 1
+        content_hash = hashlib.blake2b(
+            content.encode('utf-8'), digest_size=16).digest()
+        if content_hash in groups:
+            logger.info("Skipping duplicate %s (same content as %s)",
+                        file_path.name, groups[content_hash][1][0].name)
+            groups[content_hash][1].append(file_path)
         else:
-            logger.warning(f"No content read from: {prompt_file_path}")
+            groups[content_hash] = (content, [file_path])
 
-    if not combined_content:
+    return list(groups.values())
+
+
+def concatenate_prompt_files(prompt_file_paths):
+    """Concatenate multiple prompt files into one large text.
+
+    Files are concatenated in the order given; find_prompt_files already
+    returns existing .txt files in natural sort order.
+    """
+    if not prompt_file_paths:
+        logger.error("No prompt files provided for concatenation")
+        return ""
+
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Concatenating prompt files in this order:")
+        for i, file_path in enumerate(prompt_file_paths, 1):
+            logger.info("  %d. %s", i, file_path.name)
+
+    # Read files concurrently, then write them into one buffer in order
+    combined_content = io.StringIO()
+    successful_files = 0
+
+    # Identical files are only included once
+    for file_content, file_paths in group_duplicate_prompt_files(
+            prompt_file_paths, read_prompt_files(prompt_file_paths)):
+        combined_content.write(label_prompt_content(file_paths[0], file_content))
+        successful_files += 1
+
+    if not successful_files:
         logger.error("No content found in any prompt files")
         return ""
 
-    final_content = "\n".join(combined_content)
+    final_content = combined_content.getvalue()
     logger.info(
         f"Successfully concatenated {successful_files} files into one text block")
     logger.info(
@@ -123,107 +231,182 @@ def concatenate_prompt_files(prompt_file_paths):
     return final_content
 
 
-def parse_prompts(client, combined_content):
-    """Send concatenated content to Gemini API for structured parsing"""
+def get_cache_dir():
+    """Return the directory used for cached Gemini responses"""
+    return Path(os.getenv('STORYBOARD_GEN_CACHE_DIR', DEFAULT_CACHE_DIR))
+
+
+def get_cache_key(content):
+    """Hash the generation settings and content into a cache key"""
+    key_source = f"{GEMINI_MODEL}|{TEMPERATURE}|{SYSTEM_PROMPT}|{content}"
+    return hashlib.blake2b(key_source.encode('utf-8')).hexdigest()
+
+
+def read_cached_response(cache_key):
+    """Return a cached Gemini response, or None if there is no cache entry"""
+    cache_path = get_cache_dir() / f"{cache_key}.json"
+    try:
+        if cache_path.exists():
+            logger.info(f"Using cached Gemini response: {cache_path.name}")
+            return cache_path.read_text(encoding='utf-8')
+    except Exception as e:
+        logger.warning(f"Could not read cached response {cache_path}: {e}")
+    return None
+
+
+def write_cached_response(cache_key, response_text):
+    """Store a Gemini response in the cache, replacing any entry atomically"""
+    cache_dir = get_cache_dir()
+    cache_path = cache_dir / f"{cache_key}.json"
+    tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path.write_text(response_text, encoding='utf-8')
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        logger.warning(f"Could not write cached response {cache_path}: {e}")
+        tmp_path.unlink(missing_ok=True)
+
+
+def get_finish_reason(chunk):
+    """Return the finish reason name of the last streamed chunk, or None"""
+    if chunk is None or not chunk.candidates:
+        return None
+    finish_reason = chunk.candidates[0].finish_reason
+    return getattr(finish_reason, 'name', finish_reason)
+
+
+def build_generation_config():
+    """Return the Gemini generation config used for structured parsing"""
+    from google.genai import types
+
+    return types.GenerateContentConfig(
+        system_instruction=SYSTEM_PROMPT,
+        temperature=TEMPERATURE,
+        max_output_tokens=MAX_OUTPUT_TOKENS,
+        response_mime_type='application/json',
+        response_schema=list[Row],
+    )
+
+
+async def parse_prompts_async(client, combined_content, use_cache=True):
+    """Send content to Gemini API for structured parsing.
+
+    Raises:
+        GeminiParseError: If the request fails or the response is empty.
+    """
+    cache_key = get_cache_key(combined_content)
+    if use_cache:
+        cached = read_cached_response(cache_key)
+        if cached:
+            return cached
+
     try:
         logger.info(
-            "Sending concatenated content to Gemini for structured parsing...")
+            "Sending content to Gemini for structured parsing...")
 
-        response = client.models.generate_content(
-            model='gemini-2.5-pro',  # Using a generally available and capable model
+        # Stream the response so chunks are collected as they arrive
+        response_chunks = []
+        last_chunk = None
+        async for chunk in await client.aio.models.generate_content_stream(
+            model=GEMINI_MODEL,
             contents=combined_content,
-            config=types.GenerateContentConfig(
-                system_instruction=SYSTEM_PROMPT,
-                temperature=0.5, # lower (0.1) for consistent formatting
-                max_output_tokens=32000,
-            )
-        )
-
-        if response and response.text:
-            logger.info("Successfully received structured table from Gemini")
-            return response.text
-        else:
-            logger.error(
-                f"Empty or blocked response from Gemini. Response: {response}")
-            return f"Error: Could not parse prompts. The response was empty or blocked."
+            config=build_generation_config()
+        ):
+            last_chunk = chunk
+            if chunk.text:
+                response_chunks.append(chunk.text)
 
     except Exception as e:
         logger.error(f"Error parsing prompts with Gemini: {e}")
-        return f"Error parsing prompts with Gemini: {str(e)}"
+        raise GeminiParseError(f"Error parsing prompts with Gemini: {e}") from e
+
+    response_text = "".join(response_chunks)
+    if not response_text:
+        logger.error(
+            f"Empty or blocked response from Gemini. Response: {last_chunk}")
+        raise GeminiParseError(
+            "Could not parse prompts. The response was empty or blocked.")
+
+    logger.info("Successfully received structured rows from Gemini")
+    # A response cut off at MAX_OUTPUT_TOKENS is truncated JSON; caching it
+    # would replay the failure on every later run
+    finish_reason = get_finish_reason(last_chunk)
+    if finish_reason != 'STOP':
+        logger.warning(
+            f"Gemini response ended with finish reason {finish_reason}, not caching it")
+    elif use_cache:
+        write_cached_response(cache_key, response_text)
+    return response_text
+
+
+def iter_markdown_table_rows(markdown_table):
+    """Yield (scene, shot, prompt) tuples from a three-column markdown table.
+
+    Used as a fallback when Gemini answers with a markdown table instead of
+    JSON. Header and separator rows are skipped. Rows are yielded as they
+    are matched so they can be written without collecting the whole table.
+    """
+    # Locate the header first so text without a table is rejected early
+    # and any prose before the table is never scanned for rows
+    header_match = MARKDOWN_HEADER_PATTERN.search(markdown_table)
+    if not header_match:
+        logger.error("Could not find markdown table in Gemini response")
+        return
+
+    for match in MARKDOWN_ROW_PATTERN.finditer(markdown_table, header_match.start()):
+        scene, shot, prompt = (cell.strip() for cell in match.groups())
+        if scene.lower() == 'scene' or MARKDOWN_SEPARATOR_PATTERN.fullmatch(scene):
+            continue
+        yield scene, shot, prompt
+
 
+def parse_structured_output_to_csv(structured_output, output_path):
+    """Parse Gemini's structured output and write it to CSV.
 
-def parse_markdown_table_to_csv(markdown_table, output_path):
-    """Parse markdown table output and convert to CSV"""
+    The output is expected to be a JSON list of rows; a markdown table is
+    accepted as a fallback. Returns the number of rows written, or 0 if no
+    CSV could be created.
+    """
     try:
-        lines = markdown_table.strip().split('\n')
-
-        # Find the table start (look for header row)
-        table_start = -1
-        for i, line in enumerate(lines):
-            if '|' in line and ('Scene' in line or 'scene' in line):
-                table_start = i
-                break
-
-        if table_start == -1:
-            logger.error("Could not find markdown table in Gemini response")
-            return False
-
-        # Extract table rows (skip header and separator rows)
-        table_rows = []
-        for i in range(table_start, len(lines)):
-            line = lines[i].strip()
-            # Skip separator row
-            if '|' in line and not line.startswith('|---'):
-                # Split by | and clean up
-                cells = [cell.strip() for cell in line.split('|')]
-                # Remove empty first/last elements if they exist
-                if cells and cells[0] == '':
-                    cells = cells[1:]
-                if cells and cells[-1] == '':
-                    cells = cells[:-1]
-
-                # Only add rows with 3 columns
-                if len(cells) == 3:
-                    table_rows.append(cells)
-
-        if not table_rows:
-            logger.error("No valid table rows found in markdown output")
-            return False
-
-        # Skip the header row (first row)
-        data_rows = table_rows[1:] if len(table_rows) > 1 else []
-
-        if not data_rows:
-            logger.error("No data rows found in markdown table")
-            return False
-
-        # Write to CSV
+        try:
+            rows = json.loads(structured_output)
+        except json.JSONDecodeError as e:
+            logger.warning(
+                f"Could not decode JSON rows ({e}), trying markdown table")
+            rows = iter_markdown_table_rows(structured_output)
+        else:
+            if not isinstance(rows, list):
+                logger.error("Gemini response is not a JSON list of rows")
+                return 0
+            rows = ((row.get('scene', ''), row.get('shot', ''), row.get('prompt', ''))
+                    for row in rows)
+
+        # Write each row as soon as it is parsed
+        row_count = 0
         with open(output_path, 'w', newline='', encoding='utf-8') as csvfile:
-            fieldnames = ['scene', 'shot', 'prompt']
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+            writer = csv.writer(csvfile)
+            writer.writerow(CSV_FIELDNAMES)
+            for row_count, row in enumerate(rows, 1):
+                writer.writerow(row)
 
-            # Write header
-            writer.writeheader()
-
-            # Write data rows
-            for row in data_rows:
-                if len(row) >= 3:
-                    writer.writerow({
-                        'scene': row[0],
-                        'shot': row[1],
-                        'prompt': row[2]
-                    })
+        if not row_count:
+            logger.error("No data rows found in Gemini response")
+            Path(output_path).unlink(missing_ok=True)
+            return 0
 
         logger.info(
-            f"Successfully created CSV with {len(data_rows)} rows: {output_path}")
-        return True
+            f"Successfully created CSV with {row_count} rows: {output_path}")
+        return row_count
 
     except Exception as e:
-        logger.error(f"Error converting markdown table to CSV: {e}")
-        return False
+        logger.error(f"Error converting structured output to CSV: {e}")
+        # Leave no header-only or partial CSV behind
+        Path(output_path).unlink(missing_ok=True)
+        return 0
 
 
-def process_prompt_files_to_csv(client, prompt_file_paths, output_dir):
+def process_prompt_files_to_csv(client, prompt_file_paths, output_dir, use_cache=True):
     """Process multiple prompt files and create a single CSV table"""
     if not output_dir.exists():
         output_dir.mkdir(parents=True, exist_ok=True)
@@ -236,107 +419,109 @@ def process_prompt_files_to_csv(client, prompt_file_paths, output_dir):
         return
 
     # Send to Gemini for structured parsing
-    structured_output = parse_prompts(client, combined_content)
-    if not structured_output or structured_output.startswith("Error"):
+    try:
+        structured_output = asyncio.run(
+            parse_prompts_async(client, combined_content, use_cache))
+    except GeminiParseError as e:
         logger.error("Failed to get structured output from Gemini")
-        print(f"Error: {structured_output}")
+        print(f"Error: {e}")
         return
 
     # Create output filename
     output_filename = "prompts_table.csv"
     output_path = output_dir / output_filename
 
-    # Convert markdown table to CSV
-    if parse_markdown_table_to_csv(structured_output, output_path):
+    # Convert structured rows to CSV
+    row_count = parse_structured_output_to_csv(structured_output, output_path)
+    if row_count:
         print(f"\nCSV table created successfully: {output_path}")
-
-        # Count rows for feedback
-        try:
-            with open(output_path, 'r', encoding='utf-8') as f:
-                row_count = sum(1 for line in f) - 1  # Subtract header row
-            print(f"Total prompts extracted: {row_count}")
-        except Exception:
-            pass
+        print(f"Total prompts extracted: {row_count}")
     else:
         logger.error("Failed to create CSV table")
 
 
-def process_prompt_files_individually(client, prompt_file_paths, output_dir):
+def process_prompt_files_individually(client, prompt_file_paths, output_dir, use_cache=True):
     """Process each prompt file individually and create separate CSV tables.
 
     Each file is sent to Gemini on its own so that the request stays well
     under the model's ~32k token response limit (roughly 100-115 shots).
     This method is the most robust for very large directories because no
-    prompt file is ever combined with another.
+    prompt file is ever combined with another. Requests are dispatched
+    concurrently, up to MAX_CONCURRENT_REQUESTS at a time. Files with
+    identical content share one request and each still gets its own CSV.
     """
     if not output_dir.exists():
         output_dir.mkdir(parents=True, exist_ok=True)
         logger.info(f"Created output directory: {output_dir}")
 
-    # Sort files using natural ordering for consistency
-    sorted_files = sorted(prompt_file_paths, key=lambda x: natural_sort_key(x.name))
+    groups = group_duplicate_prompt_files(
+        prompt_file_paths, read_prompt_files(prompt_file_paths))
 
-    for prompt_file_path in sorted_files:
-        if not prompt_file_path.exists() or prompt_file_path.suffix.lower() != '.txt':
-            logger.warning(f"Skipping invalid file: {prompt_file_path}")
-            continue
-
-        logger.info(f"Processing {prompt_file_path.name} individually")
+    async def process_one(file_content, file_paths, semaphore):
+        first_file = file_paths[0]
+        try:
+            async with semaphore:
+                logger.info("Processing %s individually", first_file.name)
+                structured_output = await parse_prompts_async(client, file_content, use_cache)
+        except GeminiParseError as e:
+            logger.error("Failed to parse %s", first_file.name)
+            print(f"Error processing {first_file.name}: {e}")
+            return
 
-        file_content = read_prompt_file(prompt_file_path)
-        if not file_content:
-            logger.warning(f"Empty or unreadable prompt file: {prompt_file_path}")
-            continue
+        for prompt_file_path in file_paths:
+            output_filename = f"{prompt_file_path.stem}_prompts_table.csv"
+            output_path = output_dir / output_filename
 
-        structured_output = parse_prompts(client, file_content)
-        if not structured_output or structured_output.startswith("Error"):
-            logger.error(f"Failed to parse {prompt_file_path.name}")
-            print(f"Error processing {prompt_file_path.name}: {structured_output}")
-            continue
+            if await asyncio.to_thread(parse_structured_output_to_csv, structured_output, output_path):
+                print(f"Created CSV: {output_path.name}")
+            else:
+                logger.error("Failed to create CSV for %s", prompt_file_path.name)
 
-        output_filename = f"{prompt_file_path.stem}_prompts_table.csv"
-        output_path = output_dir / output_filename
+    async def process_all():
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        await asyncio.gather(
+            *(process_one(content, paths, semaphore) for content, paths in groups))
 
-        if parse_markdown_table_to_csv(structured_output, output_path):
-            print(f"Created CSV: {output_path.name}")
-        else:
-            logger.error(f"Failed to create CSV for {prompt_file_path.name}")
+    asyncio.run(process_all())
 
 
-def process_prompt_files_in_pairs(client, prompt_file_paths, output_dir):
+def process_prompt_files_in_pairs(client, prompt_file_paths, output_dir, use_cache=True):
     """Process prompt files two at a time and create separate CSV tables.
 
     Two files are concatenated and parsed in a single Gemini request. This
     reduces the number of API calls when dealing with many small files while
-    still helping to keep each request under the token limit.
+    still helping to keep each request under the token limit. Pairs are
+    dispatched concurrently, up to MAX_CONCURRENT_REQUESTS at a time.
     """
     if not output_dir.exists():
         output_dir.mkdir(parents=True, exist_ok=True)
         logger.info(f"Created output directory: {output_dir}")
 
-    sorted_files = sorted(prompt_file_paths, key=lambda x: natural_sort_key(x.name))
-
-    pair_num = 1
-    for i in range(0, len(sorted_files), 2):
-        pair_files = [f for f in sorted_files[i:i+2] if f.exists() and f.suffix.lower() == '.txt']
-        if not pair_files:
-            continue
+    pairs = []
+    for i in range(0, len(prompt_file_paths), 2):
+        pairs.append((len(pairs) + 1, prompt_file_paths[i:i+2]))
 
+    async def process_pair(pair_num, pair_files, semaphore):
         names = ', '.join(f.name for f in pair_files)
-        logger.info(f"Processing pair {pair_num}: {names}")
-
-        combined_content = concatenate_prompt_files(pair_files)
+        logger.info("Processing pair %d: %s", pair_num, names)
+
+        # Read the pair directly rather than going back through
+        # concatenate_prompt_files, on worker threads so other pairs'
+        # requests keep running
+        labelled_contents = await asyncio.gather(
+            *(asyncio.to_thread(read_labelled_prompt_file, f) for f in pair_files))
+        combined_content = "".join(labelled_contents)
         if not combined_content:
-            logger.warning(f"Skipping pair {pair_num} due to empty content")
-            pair_num += 1
-            continue
+            logger.warning("Skipping pair %d due to empty content", pair_num)
+            return
 
-        structured_output = parse_prompts(client, combined_content)
-        if not structured_output or structured_output.startswith("Error"):
-            logger.error(f"Failed to parse pair {pair_num}")
-            print(f"Error processing pair {pair_num}: {structured_output}")
-            pair_num += 1
-            continue
+        try:
+            async with semaphore:
+                structured_output = await parse_prompts_async(client, combined_content, use_cache)
+        except GeminiParseError as e:
+            logger.error("Failed to parse pair %d", pair_num)
+            print(f"Error processing pair {pair_num}: {e}")
+            return
 
         if len(pair_files) == 1:
             fname = f"{pair_files[0].stem}"
@@ -345,12 +530,132 @@ def process_prompt_files_in_pairs(client, prompt_file_paths, output_dir):
         output_filename = f"{fname}_prompts_table.csv"
         output_path = output_dir / output_filename
 
-        if parse_markdown_table_to_csv(structured_output, output_path):
+        if await asyncio.to_thread(parse_structured_output_to_csv, structured_output, output_path):
+            print(f"Created CSV: {output_path.name}")
+        else:
+            logger.error("Failed to create CSV for pair %d", pair_num)
+
+    async def process_all():
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        await asyncio.gather(
+            *(process_pair(num, files, semaphore) for num, files in pairs))
+
+    asyncio.run(process_all())
+
+
+def estimate_tokens(text):
+    """Roughly estimate the number of tokens in text (~4 characters per token)"""
+    return len(text) // 4
+
+
+def estimate_output_tokens(text):
+    """Estimate the output tokens needed for the rows extracted from text"""
+    return len(PROMPT_LABEL_PATTERN.findall(text)) * OUTPUT_TOKENS_PER_PROMPT
+
+
+def pack_prompt_batches(labelled_files, input_token_budget=INPUT_TOKEN_BUDGET):
+    """Greedily pack (path, content) pairs into batches under the token budgets.
+
+    Files are kept in order. A new batch is started whenever adding the
+    next file would push the estimated input tokens over input_token_budget
+    or the estimated output tokens over OUTPUT_TOKEN_BUDGET. A file that is
+    over budget on its own still gets a batch of its own.
+
+    Returns:
+        list: A list of batches, each a list of (path, content) pairs.
+    """
+    batches = []
+    batch = []
+    batch_input_tokens = 0
+    batch_output_tokens = 0
+
+    for file_path, content in labelled_files:
+        input_tokens = estimate_tokens(content)
+        output_tokens = estimate_output_tokens(content)
+
+        if batch and (batch_input_tokens + input_tokens > input_token_budget
+                      or batch_output_tokens + output_tokens > OUTPUT_TOKEN_BUDGET):
+            batches.append(batch)
+            batch = []
+            batch_input_tokens = 0
+            batch_output_tokens = 0
+
+        batch.append((file_path, content))
+        batch_input_tokens += input_tokens
+        batch_output_tokens += output_tokens
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+def process_prompt_files_adaptive(client, prompt_file_paths, output_dir, use_cache=True,
+                                  input_token_budget=INPUT_TOKEN_BUDGET):
+    """Pack prompt files into as few Gemini requests as the token budgets allow.
+
+    Consecutive files are concatenated until the estimated input or output
+    tokens would exceed the budget, so directories of many small files need
+    far fewer requests than in individual or pair mode. Batches are
+    dispatched concurrently, up to MAX_CONCURRENT_REQUESTS at a time.
+    """
+    if not output_dir.exists():
+        output_dir.mkdir(parents=True, exist_ok=True)
+        logger.info(f"Created output directory: {output_dir}")
+
+    # Identical files are only included once
+    labelled_files = [
+        (file_paths[0], label_prompt_content(file_paths[0], content))
+        for content, file_paths in group_duplicate_prompt_files(
+            prompt_file_paths, read_prompt_files(prompt_file_paths))
+    ]
+
+    batches = pack_prompt_batches(labelled_files, input_token_budget)
+    logger.info(
+        f"Packed {len(labelled_files)} files into {len(batches)} batch(es)")
+
+    async def process_batch(batch_num, batch, semaphore):
+        names = ', '.join(f.name for f, _ in batch)
+        logger.info("Processing batch %d: %s", batch_num, names)
+
+        combined_content = "".join(content for _, content in batch)
+
+        try:
+            async with semaphore:
+                structured_output = await parse_prompts_async(client, combined_content, use_cache)
+        except GeminiParseError as e:
+            logger.error("Failed to parse batch %d", batch_num)
+            print(f"Error processing batch {batch_num}: {e}")
+            return
+
+        first_file, last_file = batch[0][0], batch[-1][0]
+        if len(batch) == 1:
+            fname = f"{first_file.stem}"
+        else:
+            fname = f"{first_file.stem}_{last_file.stem}"
+        output_filename = f"{fname}_prompts_table.csv"
+        output_path = output_dir / output_filename
+
+        if await asyncio.to_thread(parse_structured_output_to_csv, structured_output, output_path):
             print(f"Created CSV: {output_path.name}")
         else:
-            logger.error(f"Failed to create CSV for pair {pair_num}")
+            logger.error("Failed to create CSV for batch %d", batch_num)
+
+    async def process_all():
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        await asyncio.gather(
+            *(process_batch(num, batch, semaphore)
+              for num, batch in enumerate(batches, 1)))
 
-        pair_num += 1
+    asyncio.run(process_all())
+
+
+def convert_sort_part(substring):
+    """Convert one natural-sort part to an int (digits) or lowercase string"""
+    if substring.isdigit():
+        return int(substring)
+    # Otherwise, convert to lowercase string for case-insensitive comparison
+    return substring.lower()
 
 
 def natural_sort_key(text):
@@ -368,32 +673,110 @@ def natural_sort_key(text):
     Returns:
         list: A list of elements (int or str) for natural sorting.
     """
-    def convert(substring):
-        if substring.isdigit():
-            return int(substring)
-        # Otherwise, convert to lowercase string for case-insensitive comparison
-        return substring.lower()
-
     # Split the text into digit and non-digit parts using regex,
-    parts = re.split(r'(\d+)', str(text))
+    parts = NATURAL_SORT_PATTERN.split(str(text))
     # then convert each part appropriately for sorting
-    return [convert(part) for part in parts]
+    return [convert_sort_part(part) for part in parts]
+
+
+def scan_txt_files(directory):
+    """Recursively collect .txt files under directory using os.scandir.
+
+    DirEntry objects carry the file type from the directory listing, so
+    only matching files are turned into Path objects.
+    """
+    txt_files = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    txt_files.extend(scan_txt_files(entry.path))
+                elif entry.name.lower().endswith('.txt') and entry.is_file():
+                    txt_files.append(Path(entry.path))
+    except OSError as e:
+        logger.warning(f"Could not scan directory {directory}: {e}")
+    return txt_files
 
 
 def find_prompt_files(directory):
-    """Find all .txt files in directory and subdirectories"""
+    """Find all .txt files in directory and subdirectories, in natural sort order.
+
+    The returned paths are existing .txt files, so the processing functions
+    do not check them again.
+    """
     if directory.is_file() and directory.suffix.lower() == '.txt':
         return [directory]
 
     if directory.is_dir():
-        txt_files = list(directory.rglob('*.txt'))
+        # sorted() computes each key once, so natural_sort_key runs N times
+        txt_files = sorted(scan_txt_files(directory),
+                           key=lambda x: natural_sort_key(x.name))
         return txt_files
 
     return []
 
 
-def get_user_inputs():
-    """Get user inputs through interactive prompts"""
+def existing_path(value):
+    """argparse type that accepts only paths that exist"""
+    path = Path(value)
+    if not path.exists():
+        raise argparse.ArgumentTypeError(f"Input path does not exist: {value}")
+    return path
+
+
+def positive_int(value):
+    """argparse type that accepts only whole numbers of at least 1"""
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be a whole number of at least 1: {value}")
+    return number
+
+
+def parse_args():
+    """Parse command line arguments; anything omitted is asked interactively"""
+    parser = argparse.ArgumentParser(
+        description="Concatenates prompt files, uses Gemini to parse them, and outputs CSV tables")
+    parser.add_argument(
+        '--input', dest='input_path', type=existing_path,
+        help="Prompt file or directory containing prompt files (.txt)")
+    parser.add_argument(
+        '--output-dir', help="Output directory for CSV tables (default: text_files)")
+    parser.add_argument(
+        '--mode', choices=['individual', 'pairs', 'adaptive'],
+        help="How to group prompt files into Gemini requests (default: individual)")
+    parser.add_argument(
+        '--batch-token-budget', type=positive_int,
+        help=f"Input token budget per batch in adaptive mode (default: {INPUT_TOKEN_BUDGET})")
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help="Ignore cached Gemini responses and always call the API")
+    parser.add_argument(
+        '--verbose', action='store_true', help="Enable verbose logging")
+    return parser.parse_args()
+
+
+def get_user_inputs(args):
+    """Get user inputs, prompting interactively for anything not given on the command line.
+
+    When --input is given the run is treated as scripted: optional settings
+    fall back to their defaults instead of being asked for.
+    """
+    interactive = args.input_path is None
+    answers = {
+        'interactive': interactive,
+        'input_path': args.input_path,
+        'output_dir': args.output_dir or "text_files",
+        'use_cache': not args.no_cache,
+        'verbose': args.verbose,
+    }
+    if not interactive:
+        return answers
+
+    import inquirer
+
     print("Image Prompts to CSV Table Generator (via Gemini API)")
     print("Concatenates prompt files, uses Gemini to parse them, and outputs a CSV table")
     print("=" * 80)
@@ -405,23 +788,33 @@ def get_user_inputs():
             path_type=inquirer.Path.ANY,
             exists=True,
         ),
-        inquirer.Text(
+    ]
+    if args.output_dir is None:
+        questions.append(inquirer.Text(
             'output_dir',
             message="Output directory for CSV table",
             default="text_files"
-        ),
-        inquirer.Confirm(
+        ))
+    if not args.no_cache:
+        questions.append(inquirer.Confirm(
+            'use_cache',
+            message="Reuse cached Gemini responses for unchanged input?",
+            default=True
+        ))
+    if not args.verbose:
+        questions.append(inquirer.Confirm(
             'verbose',
             message="Enable verbose logging?",
             default=False
-        )
-    ]
+        ))
 
-    answers = inquirer.prompt(questions)
-    if not answers:
+    prompted = inquirer.prompt(questions)
+    if not prompted:
         print("Operation cancelled.")
         sys.exit(0)
 
+    answers.update(prompted)
+    answers['input_path'] = Path(answers['input_path'])
     return answers
 
 
@@ -430,6 +823,8 @@ def get_api_key_if_needed():
     api_key = os.getenv('GEMINI_API_KEY') or os.getenv('GOOGLE_API_KEY')
 
     if not api_key:
+        import inquirer
+
         print("\nAPI Key Required")
         print("No Gemini API key found in environment variables.")
 
@@ -458,21 +853,22 @@ def get_api_key_if_needed():
 
 
 def main():
-    """Main function with interactive prompts"""
+    """Main function with command line arguments and interactive prompts"""
     try:
-        # Get user inputs interactively
-        inputs = get_user_inputs()
+        # Get user inputs from the command line, prompting for the rest
+        args = parse_args()
+
+        # Load environment variables
+        from dotenv import load_dotenv
+        load_dotenv()
+
+        inputs = get_user_inputs(args)
 
         if inputs['verbose']:
             logging.getLogger().setLevel(logging.DEBUG)
 
-        # Validate input path
-        raw_input_path = inputs['input_path']
-        cleaned_input_path = raw_input_path.strip().strip("'\"")
-        input_path = Path(cleaned_input_path)
-        if not input_path.exists():
-            logger.error(f"Input path does not exist: {input_path}")
-            sys.exit(1)
+        # Both argparse and inquirer.Path have already checked it exists
+        input_path = inputs['input_path']
 
         # Find prompt files
         prompt_files = find_prompt_files(input_path)
@@ -486,17 +882,22 @@ def main():
             print(f"  {i}. {file_path.name}")
         print("\n")
 
-        process_choice = 'individual'
-        # Offer a choice between processing files individually or in
-        # two-file batches. Individual mode avoids token limit issues
-        # with large directories, while pair mode can reduce the number
-        # of API requests for smaller datasets.
-        if input_path.is_dir() and len(prompt_files) > 1:
+        process_choice = args.mode or 'individual'
+        input_token_budget = args.batch_token_budget or INPUT_TOKEN_BUDGET
+        # Offer a choice between processing files individually, in
+        # two-file batches, or in adaptive batches. Individual mode avoids
+        # token limit issues with large directories, while pair and
+        # adaptive modes reduce the number of API requests for directories
+        # of smaller files.
+        if (args.mode is None and inputs['interactive']
+                and input_path.is_dir() and len(prompt_files) > 1):
+            import inquirer
+
             mode_question = [
                 inquirer.List(
                     'mode',
-                    message="Process prompt files individually or in pairs?",
-                    choices=['individual', 'pairs'],
+                    message="Process prompt files individually, in pairs, or in adaptive batches?",
+                    choices=['individual', 'pairs', 'adaptive'],
                     default='individual'
                 )
             ]
@@ -506,6 +907,24 @@ def main():
                 sys.exit(0)
             process_choice = answers['mode']
 
+        if (process_choice == 'adaptive' and args.batch_token_budget is None
+                and inputs['interactive']):
+            import inquirer
+
+            budget_question = [
+                inquirer.Text(
+                    'token_budget',
+                    message="Input token budget per batch",
+                    default=str(INPUT_TOKEN_BUDGET),
+                    validate=lambda _, value: value.strip().isdigit() and int(value) > 0
+                )
+            ]
+            answers = inquirer.prompt(budget_question)
+            if not answers:
+                print("Operation cancelled.")
+                sys.exit(0)
+            input_token_budget = int(answers['token_budget'])
+
         # Get API key if needed
         api_key = get_api_key_if_needed()
 
@@ -535,10 +954,17 @@ def main():
 
         if process_choice == 'pairs':
             print("\nProcessing prompt files in pairs...")
-            process_prompt_files_in_pairs(client, prompt_files, output_dir)
+            process_prompt_files_in_pairs(
+                client, prompt_files, output_dir, inputs['use_cache'])
+        elif process_choice == 'adaptive':
+            print("\nProcessing prompt files in adaptive batches...")
+            process_prompt_files_adaptive(
+                client, prompt_files, output_dir, inputs['use_cache'],
+                input_token_budget)
         else:
             print("\nProcessing prompt files individually...")
-            process_prompt_files_individually(client, prompt_files, output_dir)
+            process_prompt_files_individually(
+                client, prompt_files, output_dir, inputs['use_cache'])
 
         print(f"\nOutput saved to: {output_dir.absolute()}")
 
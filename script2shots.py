@@ -1,16 +1,31 @@
+import argparse
+import asyncio
+import hashlib
+import importlib.util
+import json
 import logging
+import mmap
 import os
+import random
 import sys
 import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from google import genai
-from google.genai import types
-from dotenv import load_dotenv
-import inquirer
-from striprtf.striprtf import rtf_to_text
+from google.genai import errors, types
+import httpx
 
-# Load environment variables
-load_dotenv()
+# inquirer, striprtf, numpy and dotenv are imported where they are used so
+# that --help, scripted runs and .txt-only runs do not pay for them
+
+# Load environment variables before the settings below read them; dotenv is
+# only imported when there is a .env file to load
+ENV_FILE = next((path for path in (Path('.env'), Path(__file__).with_name('.env'))
+                 if path.is_file()), None)
+if ENV_FILE:
+    from dotenv import load_dotenv
+    load_dotenv(ENV_FILE)
 
 # Configure logging
 logging.basicConfig(
@@ -19,6 +34,192 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Gemini generation settings (also part of the response cache key)
+GEMINI_MODEL = 'gemini-2.5-pro'  # Using a generally available and capable model
+TEMPERATURE = 0.7
+
+
+def get_concurrency_from_env(default=8):
+    """Return GENAI_CONCURRENCY as an integer of at least 1, or default if unset or invalid"""
+    value = os.getenv('GENAI_CONCURRENCY')
+    if value is None:
+        return default
+    try:
+        concurrency = int(value)
+    except ValueError:
+        concurrency = 0
+    if concurrency < 1:
+        # A semaphore of 0 would never let a request through
+        logger.warning(
+            f"GENAI_CONCURRENCY must be a whole number of at least 1, got {value!r}; using {default}")
+        return default
+    return concurrency
+
+
+def get_int_from_env(name, default, minimum):
+    """Return env var name as an integer of at least minimum, or default if unset or invalid"""
+    value = os.getenv(name)
+    if not value:
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        number = minimum - 1
+    if number < minimum:
+        logger.warning(
+            f"{name} must be a whole number of at least {minimum}, got {value!r}; using {default}")
+        return default
+    return number
+
+
+def get_semantic_threshold_from_env():
+    """Return STORYBOARD_GEN_SEMANTIC_THRESHOLD as a float in (0, 1], or None if unset or invalid"""
+    value = os.getenv('STORYBOARD_GEN_SEMANTIC_THRESHOLD')
+    if not value:
+        return None
+    try:
+        threshold = float(value)
+    except ValueError:
+        threshold = 0.0
+    if not 0 < threshold <= 1:
+        logger.warning(
+            f"STORYBOARD_GEN_SEMANTIC_THRESHOLD must be a number above 0 and at most 1, "
+            f"got {value!r}; leaving the semantic cache off")
+        return None
+    return threshold
+
+
+# Maximum number of Gemini requests allowed in flight at once
+MAX_CONCURRENT_REQUESTS = get_concurrency_from_env()
+
+# File extensions accepted as scripts
+SCRIPT_EXTENSIONS = ('.txt', '.rtf')
+
+# Connection pool size of the shared client, so concurrent requests and
+# retries reuse open TLS connections instead of handshaking again
+MAX_HTTP_CONNECTIONS = 32
+
+# Per-request timeout in milliseconds; long scripts can take minutes
+REQUEST_TIMEOUT_MS = 600_000
+
+# Rate-limited, timed-out and server-side failures are retried with
+# exponential backoff and jitter, at most this many attempts per request
+MAX_ATTEMPTS = 5
+RETRY_MAX_DELAY = 30
+RETRYABLE_STATUS_CODES = frozenset((408, 429))
+
+# When scripts are processed separately, consecutive small scripts are
+# packed into one request up to this many estimated input tokens. Shot
+# lists run longer than their scripts, so the budget is kept well below
+# the model's output limit. Set SCRIPT_BATCH_TOKEN_BUDGET=0 to disable.
+BATCH_TOKEN_BUDGET = get_int_from_env('SCRIPT_BATCH_TOKEN_BUDGET', 8000, minimum=0)
+
+# Line the model writes after the Nth shot list of a batched request
+BATCH_DELIMITER_PATTERN = re.compile(r'^=====END SCRIPT \d+=====[ \t]*$', re.MULTILINE)
+
+# Scripts larger than this many bytes are skipped rather than sent to
+# Gemini, where they would exceed the input limit. RTF markup inflates
+# file size several-fold, hence the generous default.
+MAX_SCRIPT_BYTES = get_int_from_env('SCRIPT_MAX_BYTES', 2 << 20, minimum=1)
+
+# Maximum number of threads used to read script chunks concurrently
+MAX_READ_WORKERS = 32
+
+# Buffer size for script reads, so large scripts are read in few syscalls
+READ_BUFFER_SIZE = 1 << 20
+
+# Scripts at least this large are decoded straight from a memory map, which
+# skips the intermediate bytes copy of a regular read
+MMAP_THRESHOLD = 1 << 20
+
+# Cached Gemini responses live here unless STORYBOARD_GEN_CACHE_DIR is set
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "storyboard_gen"
+
+# Semantic cache: when STORYBOARD_GEN_SEMANTIC_THRESHOLD is set (e.g. 0.97),
+# a script whose embedding is at least that cosine-similar to a cached one
+# reuses the cached shot list. Off by default because a near match still
+# returns the shot list of a slightly different script.
+SEMANTIC_CACHE_THRESHOLD = get_semantic_threshold_from_env()
+EMBEDDING_MODEL = 'text-embedding-004'
+# Input limit of EMBEDDING_MODEL; longer scripts would be rejected or
+# truncated (so edits past the cut-off go unnoticed) and skip the lookup
+EMBEDDING_MAX_TOKENS = 2048
+
+# Splits file names into digit and non-digit runs for natural sorting
+NATURAL_SORT_PATTERN = re.compile(r'(\d+)')
+
+# RTF groups whose content is never part of the visible text
+RTF_DESTINATIONS = frozenset((
+    'aftncn', 'aftnsep', 'aftnsepc', 'annotation', 'atnauthor', 'atndate',
+    'atnicn', 'atnid', 'atnparent', 'atnref', 'atntime', 'atrfend',
+    'atrfstart', 'author', 'background', 'bkmkend', 'bkmkstart', 'blipuid',
+    'buptim', 'category', 'colorschememapping', 'colortbl', 'comment',
+    'company', 'creatim', 'datafield', 'datastore', 'defchp', 'defpap', 'do',
+    'doccomm', 'docvar', 'dptxbxtext', 'ebcend', 'ebcstart', 'factoidname',
+    'falt', 'fchars', 'ffdeftext', 'ffentrymcr', 'ffexitmcr', 'ffformat',
+    'ffhelptext', 'ffl', 'ffname', 'ffstattext', 'file', 'filetbl',
+    'fldinst', 'fldtype', 'fname', 'fontemb', 'fontfile', 'fonttbl',
+    'footer', 'footerf', 'footerl', 'footerr', 'footnote', 'formfield',
+    'ftncn', 'ftnsep', 'ftnsepc', 'g', 'generator', 'gridtbl', 'header',
+    'headerf', 'headerl', 'headerr', 'hl', 'hlfr', 'hlinkbase', 'hlloc',
+    'hlsrc', 'hsv', 'htmltag', 'info', 'keycode', 'keywords',
+    'latentstyles', 'lchars', 'levelnumbers', 'leveltext', 'lfolevel',
+    'linkval', 'list', 'listlevel', 'listname', 'listoverride',
+    'listoverridetable', 'listpicture', 'liststylename', 'listtable',
+    'listtext', 'lsdlockedexcept', 'macc', 'maccPr', 'mailmerge', 'maln',
+    'malnScr', 'manager', 'margPr', 'mbar', 'mbarPr', 'mbaseJc', 'mbegChr',
+    'mborderBox', 'mborderBoxPr', 'mbox', 'mboxPr', 'mchr', 'mcount',
+    'mctrlPr', 'md', 'mdeg', 'mdegHide', 'mden', 'mdiff', 'mdPr', 'me',
+    'mendChr', 'meqArr', 'meqArrPr', 'mf', 'mfName', 'mfPr', 'mfunc',
+    'mfuncPr', 'mgroupChr', 'mgroupChrPr', 'mgrow', 'mhideBot', 'mhideLeft',
+    'mhideRight', 'mhideTop', 'mhtmltag', 'mlim', 'mlimloc', 'mlimlow',
+    'mlimlowPr', 'mlimupp', 'mlimuppPr', 'mm', 'mmaddfieldname', 'mmath',
+    'mmathPict', 'mmathPr', 'mmaxdist', 'mmc', 'mmcJc', 'mmconnectstr',
+    'mmconnectstrdata', 'mmcPr', 'mmcs', 'mmdatasource', 'mmheadersource',
+    'mmmailsubject', 'mmodso', 'mmodsofilter', 'mmodsofldmpdata',
+    'mmodsomappedname', 'mmodsoname', 'mmodsorecipdata', 'mmodsosort',
+    'mmodsosrc', 'mmodsotable', 'mmodsoudl', 'mmodsoudldata',
+    'mmodsouniquetag', 'mmPr', 'mmquery', 'mmr', 'mnary', 'mnaryPr',
+    'mnoBreak', 'mnum', 'mobjDist', 'moMath', 'moMathPara', 'moMathParaPr',
+    'mopEmu', 'mphant', 'mphantPr', 'mplcHide', 'mpos', 'mr', 'mrad',
+    'mradPr', 'mrPr', 'msepChr', 'mshow', 'mshp', 'msPre', 'msPrePr',
+    'msSub', 'msSubPr', 'msSubSup', 'msSubSupPr', 'msSup', 'msSupPr',
+    'mstrikeBLTR', 'mstrikeH', 'mstrikeTLBR', 'mstrikeV', 'msub',
+    'msubHide', 'msup', 'msupHide', 'mtransp', 'mtype', 'mvertJc', 'mvfmf',
+    'mvfml', 'mvtof', 'mvtol', 'mzeroAsc', 'mzeroDesc', 'mzeroWid',
+    'nesttableprops', 'nextfile', 'nonesttables', 'objalias', 'objclass',
+    'objdata', 'object', 'objname', 'objsect', 'objtime', 'oldcprops',
+    'oldpprops', 'oldsprops', 'oldtprops', 'oleclsid', 'operator',
+    'panose', 'password', 'passwordhash', 'pgp', 'pgptbl', 'picprop',
+    'pict', 'pn', 'pnseclvl', 'pntext', 'pntxta', 'pntxtb', 'printim',
+    'private', 'propname', 'protend', 'protstart', 'protusertbl', 'pxe',
+    'result', 'revtbl', 'revtim', 'rsidtbl', 'rxe', 'shp', 'shpgrp',
+    'shpinst', 'shppict', 'shprslt', 'shptxt', 'sn', 'sp', 'staticval',
+    'stylesheet', 'subject', 'sv', 'svb', 'tc', 'template', 'themedata',
+    'title', 'txe', 'ud', 'upr', 'userprops', 'wgrffmtfilter',
+    'windowcaption', 'writereservation', 'writereservhash', 'xe',
+    'xform', 'xmlattrname', 'xmlattrvalue', 'xmlclose', 'xmlname',
+    'xmlnstbl', 'xmlopen',
+))
+
+# RTF control words and symbols that map directly to output text
+RTF_SPECIAL_CHARS = {
+    'par': '\n', 'sect': '\n\n', 'page': '\n\n', 'line': '\n',
+    'tab': '\t', 'emdash': '\u2014', 'endash': '\u2013',
+    'emspace': '\u2003', 'enspace': '\u2002', 'qmspace': '\u2005',
+    'bullet': '\u2022', 'lquote': '\u2018', 'rquote': '\u2019',
+    'ldblquote': '\u201C', 'rdblquote': '\u201D', 'row': '\n',
+    'cell': '|', 'nestcell': '|', '~': '\xa0', '\n': '\n', '\r': '\r',
+    '{': '{', '}': '}', '\\': '\\', '-': '\xad', '_': '\u2011',
+}
+
+# One token per RTF control word, hex escape, control symbol, brace or run
+# of plain text, so ordinary text is consumed in a single match
+RTF_TOKEN_PATTERN = re.compile(
+    r"\\([a-z]{1,32})(-?\d{1,10})?[ ]?|\\'([0-9a-f]{2})|\\([^a-z])|([{}])"
+    r"|[\r\n]+|([^\\{}\r\n]+)",
+    re.IGNORECASE)
+
 # System prompt for shot list generation
 SYSTEM_PROMPT = """You are a professional cinematographer and director of an oscar winning biographical film. Convert the provided film script into a detailed shot list. 
 
@@ -67,10 +268,165 @@ If the input script is in Chinese, translate all dialogue and descriptions to En
 
 Convert the following script:"""
 
+# SYSTEM_PROMPT encoded once; the SDK takes str, so the bytes only feed the
+# cache key hash below
+SYSTEM_PROMPT_BYTES = SYSTEM_PROMPT.encode('utf-8')
+
+# Hash state for the fixed "model|temperature|system prompt|" prefix of
+# every cache key; get_cache_key copies it and hashes only the request
+CACHE_KEY_HASH_PREFIX = hashlib.sha256(
+    f"{GEMINI_MODEL}|{TEMPERATURE}|".encode('utf-8') + SYSTEM_PROMPT_BYTES + b"|")
+
+# Prefix of the user content sent with each script
+SCRIPT_PREFIX = "SCRIPT: "
+
 
 def create_gemini_client(api_key):
-    """Create and return a Gemini API client"""
-    return genai.Client(api_key=api_key)
+    """Create and return a Gemini API client.
+
+    A single client is created per run and shared by every request. Its
+    httpx connection pool holds MAX_HTTP_CONNECTIONS keep-alive connections,
+    and HTTP/2 is used when the optional h2 package is installed.
+    """
+    client_args = {
+        'http2': importlib.util.find_spec('h2') is not None,
+        'limits': httpx.Limits(
+            max_connections=MAX_HTTP_CONNECTIONS,
+            max_keepalive_connections=MAX_HTTP_CONNECTIONS,
+        ),
+    }
+    http_options = types.HttpOptions(
+        timeout=REQUEST_TIMEOUT_MS, client_args=client_args)
+    # With aiohttp installed the SDK passes async_client_args to aiohttp,
+    # which does not accept httpx options, so only set them for httpx
+    if importlib.util.find_spec('aiohttp') is None:
+        http_options.async_client_args = client_args
+
+    return genai.Client(api_key=api_key, http_options=http_options)
+
+
+def build_generation_config():
+    """Return the generation config sent with every shot list request"""
+    return types.GenerateContentConfig(
+        system_instruction=SYSTEM_PROMPT,
+        temperature=TEMPERATURE,
+    )
+
+
+def get_finish_reason(response):
+    """Return the finish reason name of a response or streamed chunk, or None"""
+    if response is None or not response.candidates:
+        return None
+    finish_reason = response.candidates[0].finish_reason
+    return getattr(finish_reason, 'name', finish_reason)
+
+
+def is_retryable_error(error):
+    """Return True for rate limits, timeouts and server errors worth retrying"""
+    if isinstance(error, (errors.ServerError, httpx.TimeoutException, httpx.NetworkError)):
+        return True
+    return getattr(error, 'code', None) in RETRYABLE_STATUS_CODES
+
+
+def get_retry_delay(attempt):
+    """Return the backoff delay in seconds before retrying after the given attempt"""
+    return min(RETRY_MAX_DELAY, 2 ** attempt + random.random())
+
+
+def read_script_text(file_path, encoding='utf-8'):
+    """Read and decode a script file, ignoring undecodable bytes.
+
+    Small files are read with a single large buffered read. Large files are
+    memory-mapped and decoded from the mapping, so only the decoded string
+    is held in memory rather than a bytes copy as well.
+    """
+    with open(file_path, 'rb', buffering=READ_BUFFER_SIZE) as file:
+        if os.fstat(file.fileno()).st_size < MMAP_THRESHOLD:
+            return file.read().decode(encoding, errors='ignore')
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return str(mapped, encoding, errors='ignore')
+
+
+def strip_script_content(content):
+    """Strip surrounding whitespace, skipping the copy when there is none"""
+    if content and (content[0].isspace() or content[-1].isspace()):
+        return content.strip()
+    return content
+
+
+def rtf_to_plain_text(rtf, encoding='cp1252'):
+    """Convert RTF markup to plain text with a single precompiled-regex scan"""
+    stack = []
+    ignorable = False  # Whether the current group is a hidden destination
+    ucskip = 1  # Fallback characters that follow each \u escape
+    curskip = 0  # Fallback characters still left to skip
+    hexes = []
+    out = []
+
+    for match in RTF_TOKEN_PATTERN.finditer(rtf):
+        word, arg, hex_code, char, brace, text = match.groups()
+        if hexes and not hex_code:
+            out.append(bytes.fromhex(''.join(hexes)).decode(
+                encoding, errors='ignore'))
+            hexes = []
+        if text:
+            if curskip:
+                skipped = min(curskip, len(text))
+                text = text[skipped:]
+                curskip -= skipped
+            if text and not ignorable:
+                out.append(text)
+        elif brace:
+            curskip = 0
+            if brace == '{':
+                stack.append((ucskip, ignorable))
+            elif stack:
+                ucskip, ignorable = stack.pop()
+            else:
+                ucskip, ignorable = 0, True
+        elif char:
+            curskip = 0
+            if char == '*':
+                ignorable = True
+            elif not ignorable and char in RTF_SPECIAL_CHARS:
+                out.append(RTF_SPECIAL_CHARS[char])
+        elif word:
+            curskip = 0
+            if word in RTF_DESTINATIONS:
+                ignorable = True
+            elif word == 'ansicpg' and arg:
+                encoding = f"cp{arg}"
+            elif ignorable:
+                pass
+            elif word in RTF_SPECIAL_CHARS:
+                out.append(RTF_SPECIAL_CHARS[word])
+            elif word == 'uc' and arg:
+                ucskip = int(arg)
+            elif word == 'u':
+                if arg:
+                    code = int(arg)
+                    out.append(chr(code + 0x10000 if code < 0 else code))
+                curskip = ucskip
+        elif hex_code:
+            if curskip:
+                curskip -= 1
+            elif not ignorable:
+                hexes.append(hex_code)
+
+    if hexes:
+        out.append(bytes.fromhex(''.join(hexes)).decode(
+            encoding, errors='ignore'))
+    return ''.join(out)
+
+
+def convert_rtf(rtf):
+    """Convert RTF to text, falling back to striprtf if the fast path fails"""
+    try:
+        return rtf_to_plain_text(rtf)
+    except Exception as e:
+        logger.warning(f"Fast RTF conversion failed, using striprtf: {e}")
+        from striprtf.striprtf import rtf_to_text
+        return rtf_to_text(rtf)
 
 
 def read_script_file(file_path):
@@ -79,16 +435,14 @@ def read_script_file(file_path):
         file_extension = file_path.suffix.lower()
 
         if file_extension == '.rtf':
-            # Handle RTF files
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as file:
-                rtf_content = file.read()
-            # Convert RTF to plain text
-            content = rtf_to_text(rtf_content).strip()
+            # Handle RTF files: decode and convert RTF to plain text
+            content = strip_script_content(convert_rtf(
+                read_script_text(file_path)))
             logger.info(f"Successfully converted RTF script: {file_path}")
         elif file_extension == '.txt':
             # Handle plain text files
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as file:
-                content = file.read().strip()
+            content = strip_script_content(
+                read_script_text(file_path))
             logger.info(f"Successfully read text script: {file_path}")
         else:
             logger.error(f"Unsupported file format: {file_extension}")
@@ -106,13 +460,10 @@ def read_script_file(file_path):
         # Try with different encodings for Chinese text
         try:
             logger.info(f"Trying alternative encoding for: {file_path}")
+            text = read_script_text(file_path, 'gbk')
             if file_path.suffix.lower() == '.rtf':
-                with open(file_path, 'r', encoding='gbk', errors='ignore') as file:
-                    rtf_content = file.read()
-                content = rtf_to_text(rtf_content).strip()
-            else:
-                with open(file_path, 'r', encoding='gbk', errors='ignore') as file:
-                    content = file.read().strip()
+                text = convert_rtf(text)
+            content = strip_script_content(text)
             logger.info(f"Successfully read with GBK encoding: {file_path}")
             return content
         except Exception as e2:
@@ -120,34 +471,256 @@ def read_script_file(file_path):
             return ""
 
 
-def generate_shot_list(client, script_content, script_name):
-    """Generate shot list from script content using Gemini API"""
+def get_cache_dir():
+    """Return the directory used for cached Gemini responses"""
+    return Path(os.getenv('STORYBOARD_GEN_CACHE_DIR', DEFAULT_CACHE_DIR))
+
+
+def get_cache_key(user_content):
+    """Hash the generation settings and request content into a cache key"""
+    key_hash = CACHE_KEY_HASH_PREFIX.copy()
+    key_hash.update(user_content.encode('utf-8'))
+    return key_hash.hexdigest()
+
+
+def get_script_cache_key(script_name, script_content):
+    """Return the cache key of a single script's shot list.
+
+    This is the key of the request generate_shot_list_async sends for the
+    script, so batched and unbatched runs share the same per-script entries.
+    """
+    return get_cache_key(SCRIPT_PREFIX + script_name + "\n\n" + script_content)
+
+
+def read_cached_response(cache_key):
+    """Return a cached Gemini response, or None if there is no cache entry"""
+    cache_path = get_cache_dir() / f"{cache_key}.txt"
+    try:
+        if cache_path.exists():
+            logger.info(f"Using cached Gemini response: {cache_path.name}")
+            return cache_path.read_text(encoding='utf-8')
+    except Exception as e:
+        logger.warning(f"Could not read cached response {cache_path}: {e}")
+    return None
+
+
+def write_cached_response(cache_key, response_text):
+    """Store a Gemini response in the cache, replacing any entry atomically"""
+    cache_dir = get_cache_dir()
+    cache_path = cache_dir / f"{cache_key}.txt"
+    tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path.write_text(response_text, encoding='utf-8')
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        logger.warning(f"Could not write cached response {cache_path}: {e}")
+        tmp_path.unlink(missing_ok=True)
+
+
+def write_cached_response_file(cache_key, source_path):
+    """Copy a saved shot list file into the cache, replacing any entry atomically"""
+    cache_dir = get_cache_dir()
+    cache_path = cache_dir / f"{cache_key}.txt"
+    tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(source_path, tmp_path)
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        logger.warning(f"Could not write cached response {cache_path}: {e}")
+        tmp_path.unlink(missing_ok=True)
+
+
+def get_semantic_index_paths():
+    """Return the embedding matrix and cache key list paths for the semantic cache.
+
+    The index is scoped to the current model, settings and system prompt so
+    a prompt change never matches shot lists generated under the old one.
+    """
+    namespace = get_cache_key("")[:16]
+    cache_dir = get_cache_dir()
+    return (cache_dir / f"semantic_{EMBEDDING_MODEL}_{namespace}.npy",
+            cache_dir / f"semantic_{EMBEDDING_MODEL}_{namespace}.json")
+
+
+def load_semantic_index():
+    """Load the semantic cache as (embedding matrix, list of cache keys)"""
+    import numpy as np
+
+    matrix_path, keys_path = get_semantic_index_paths()
+    try:
+        if matrix_path.exists() and keys_path.exists():
+            matrix = np.load(matrix_path)
+            cache_keys = json.loads(keys_path.read_text(encoding='utf-8'))
+            if len(cache_keys) == matrix.shape[0]:
+                return matrix, cache_keys
+            logger.warning("Semantic cache index is inconsistent, ignoring it")
+    except Exception as e:
+        logger.warning(f"Could not load semantic cache index: {e}")
+    return None, []
+
+
+def normalize_embedding(values):
+    """Return values as a unit-length float32 vector"""
+    import numpy as np
+
+    embedding = np.asarray(values, dtype=np.float32)
+    norm = np.linalg.norm(embedding)
+    return embedding / norm if norm else embedding
+
+
+def find_semantic_match(embedding):
+    """Return the cached shot list most similar to embedding, if above threshold"""
+    import numpy as np
+
+    matrix, cache_keys = load_semantic_index()
+    if matrix is None or not cache_keys:
+        return None
+
+    # Rows are stored normalized, so the dot product is the cosine similarity
+    similarities = matrix @ embedding
+    best = int(np.argmax(similarities))
+    if similarities[best] < SEMANTIC_CACHE_THRESHOLD:
+        return None
+
+    logger.info(
+        f"Found semantically similar cached script (similarity {similarities[best]:.3f})")
+    return read_cached_response(cache_keys[best])
+
+
+def add_to_semantic_index(embedding, cache_key):
+    """Append an embedding and its cache key to the semantic cache"""
+    import numpy as np
+
+    matrix_path, keys_path = get_semantic_index_paths()
+    matrix, cache_keys = load_semantic_index()
+    matrix = embedding[np.newaxis, :] if matrix is None else np.vstack([matrix, embedding])
+    cache_keys.append(cache_key)
+
+    pid = os.getpid()
+    matrix_tmp = matrix_path.with_name(f"{matrix_path.name}.{pid}.tmp")
+    keys_tmp = keys_path.with_name(f"{keys_path.name}.{pid}.tmp")
+    try:
+        matrix_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(matrix_tmp, 'wb') as file:
+            np.save(file, matrix)
+        keys_tmp.write_text(json.dumps(cache_keys), encoding='utf-8')
+        os.replace(matrix_tmp, matrix_path)
+        os.replace(keys_tmp, keys_path)
+    except Exception as e:
+        logger.warning(f"Could not update semantic cache index: {e}")
+        matrix_tmp.unlink(missing_ok=True)
+        keys_tmp.unlink(missing_ok=True)
+
+
+async def embed_for_semantic_cache_async(client, script_content):
+    """Embed script content for the semantic cache, or return None if disabled or failed"""
+    if SEMANTIC_CACHE_THRESHOLD is None:
+        return None
+    if estimate_tokens(script_content) > EMBEDDING_MAX_TOKENS:
+        logger.debug("Script is too long to embed, skipping the semantic cache")
+        return None
+    try:
+        result = await client.aio.models.embed_content(
+            model=EMBEDDING_MODEL, contents=script_content)
+        return normalize_embedding(result.embeddings[0].values)
+    except Exception as e:
+        logger.warning(f"Could not embed script for semantic cache: {e}")
+        return None
+
+
+async def stream_shot_list_async(client, user_content, output_path):
+    """Stream a Gemini response into output_path.
+
+    Returns:
+        tuple: (characters written, finish reason name of the last chunk)
+    """
+    written = 0
+    last_chunk = None
+    with open(output_path, 'w', encoding='utf-8') as file:
+        async for chunk in await client.aio.models.generate_content_stream(
+                model=GEMINI_MODEL,
+                contents=user_content,
+                config=build_generation_config()):
+            last_chunk = chunk
+            if chunk.text:
+                file.write(chunk.text)
+                file.flush()
+                written += len(chunk.text)
+    return written, get_finish_reason(last_chunk)
+
+
+async def run_with_retries_async(description, request):
+    """Await request(), retrying transient errors with backoff"""
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            return await request()
+        except Exception as e:
+            if attempt == MAX_ATTEMPTS:
+                raise
+            if is_retryable_error(e):
+                delay = get_retry_delay(attempt)
+                logger.warning(
+                    f"Attempt {attempt} for {description} failed ({e}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+            else:
+                raise
+
+
+async def generate_shot_list_async(client, script_content, script_name, output_path, use_cache=True,
+                                   use_semantic_cache=True, embedding=None):
+    """Generate a shot list from script content using Gemini API.
+
+    The response is streamed straight into output_path as it arrives. An
+    embedding already looked up by the caller is added to the semantic
+    cache alongside the response. Returns True if a shot list was saved.
+    """
     try:
-        user_content = f"SCRIPT: {script_name}\n\n{script_content}"
+        user_content = SCRIPT_PREFIX + script_name + "\n\n" + script_content
+
+        cache_key = get_script_cache_key(script_name, script_content)
+        if use_cache:
+            cached = read_cached_response(cache_key)
+            if cached:
+                return await asyncio.to_thread(save_shot_list, cached, output_path)
+
+            if use_semantic_cache:
+                embedding = await embed_for_semantic_cache_async(client, script_content)
+            if embedding is not None:
+                cached = find_semantic_match(embedding)
+                if cached:
+                    return await asyncio.to_thread(save_shot_list, cached, output_path)
 
         logger.info(f"Generating shot list for: {script_name}")
 
-        response = client.models.generate_content(
-            model='gemini-2.5-pro',  # Using a generally available and capable model
-            contents=user_content,
-            config=types.GenerateContentConfig(
-                system_instruction=SYSTEM_PROMPT,
-                temperature=0.7,
-            )
-        )
+        written, finish_reason = await run_with_retries_async(
+            script_name,
+            lambda: stream_shot_list_async(client, user_content, output_path))
 
-        if response and response.text:
-            logger.info(f"Successfully generated shot list for: {script_name}")
-            return response.text
-        else:
-            # It's helpful to log the actual response for debugging safety blocks
+        if not written:
             logger.error(
-                f"Empty or blocked response from Gemini for: {script_name}. Response: {response}")
-            return f"Error: Could not generate shot list for {script_name}. The response was empty or blocked."
+                f"Empty or blocked response from Gemini for: {script_name}")
+        elif finish_reason != 'STOP':
+            # A shot list cut off at the output limit or stopped by a safety
+            # filter is incomplete; saving or caching it would hide the failure
+            logger.error(
+                f"Gemini response for {script_name} ended with finish reason {finish_reason}")
+        else:
+            logger.info(f"Successfully generated shot list for: {script_name}")
+            logger.info(f"Shot list saved to: {output_path}")
+            if use_cache:
+                write_cached_response_file(cache_key, output_path)
+                if embedding is not None:
+                    add_to_semantic_index(embedding, cache_key)
+            return True
 
     except Exception as e:
         logger.error(f"Error generating shot list for {script_name}: {e}")
-        return f"Error generating shot list for {script_name}: {str(e)}"
+
+    # Leave no partial or empty file behind to be mistaken for a shot list
+    output_path.unlink(missing_ok=True)
+    return False
 
 
 def save_shot_list(shot_list, output_path):
@@ -162,15 +735,139 @@ def save_shot_list(shot_list, output_path):
         return False
 
 
-def process_script_files(client, script_paths, output_dir):
-    """Process multiple script files and generate shot lists"""
+def estimate_tokens(text):
+    """Conservatively estimate the number of tokens in text.
+
+    ASCII text runs about 4 characters per token, but CJK and other
+    non-ASCII text is closer to one token per character, so those
+    characters are counted as a token each.
+    """
+    non_ascii = len(text) - len(text.encode('ascii', 'ignore'))
+    return (len(text) - non_ascii) // 4 + non_ascii
+
+
+def pack_script_batches(scripts, token_budget=BATCH_TOKEN_BUDGET):
+    """Greedily pack (path, content) pairs into batches under token_budget.
+
+    Scripts are kept in order. A new batch is started whenever adding the
+    next script would push the estimated input tokens over token_budget. A
+    script that is over budget on its own still gets a batch of its own.
+
+    Returns:
+        list: A list of batches, each a list of (path, content) pairs.
+    """
+    batches = []
+    batch = []
+    batch_tokens = 0
+
+    for script_path, content in scripts:
+        tokens = estimate_tokens(content)
+
+        if batch and batch_tokens + tokens > token_budget:
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+
+        batch.append((script_path, content))
+        batch_tokens += tokens
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+def build_batch_content(batch):
+    """Build one request asking for a delimited shot list per script in batch"""
+    parts = [
+        f"The following {len(batch)} scripts are separate. Return one shot list "
+        f"per script, in order. After the shot list for script N, write the "
+        f"line =====END SCRIPT N===== on its own."
+    ]
+    for number, (script_path, content) in enumerate(batch, 1):
+        parts.append(f"SCRIPT {number}: {script_path.name}\n\n{content}")
+    return "\n\n".join(parts)
+
+
+def split_batch_response(response_text, expected_count):
+    """Split a batched response into shot lists, or return None if they do not line up"""
+    shot_lists = [part.strip() for part in BATCH_DELIMITER_PATTERN.split(response_text)]
+    if shot_lists and not shot_lists[-1]:
+        shot_lists.pop()
+    if len(shot_lists) != expected_count or not all(shot_lists):
+        return None
+    return shot_lists
+
+
+async def generate_shot_list_batch_async(client, batch, output_dir, use_cache=True, embeddings=None):
+    """Generate shot lists for several small scripts with one Gemini request.
+
+    Each shot list is cached under its own script's key rather than the
+    batch's, so editing one script does not invalidate its batch-mates.
+    embeddings maps script paths to embeddings for the semantic cache.
+
+    Returns:
+        list: One success flag per script, or None if the response could not
+        be split per script and the scripts should be sent individually.
+    """
+    names = ', '.join(script_path.name for script_path, _ in batch)
+    user_content = build_batch_content(batch)
+
+    logger.info(f"Generating batched shot lists for: {names}")
+    try:
+        response = await run_with_retries_async(
+            names,
+            lambda: client.aio.models.generate_content(
+                model=GEMINI_MODEL,
+                contents=user_content,
+                config=build_generation_config()))
+    except Exception as e:
+        logger.warning(f"Batched request failed for {names}: {e}")
+        return None
+    response_text = response.text if response else None
+    if not response_text:
+        logger.warning(f"Empty or blocked batched response for: {names}")
+        return None
+    finish_reason = get_finish_reason(response)
+    if finish_reason != 'STOP':
+        logger.warning(
+            f"Batched response for {names} ended with finish reason {finish_reason}")
+        return None
+
+    shot_lists = split_batch_response(response_text, len(batch))
+    if shot_lists is None:
+        logger.warning(
+            f"Batched response did not contain {len(batch)} delimited shot lists: {names}")
+        return None
+
+    results = []
+    for (script_path, script_content), shot_list in zip(batch, shot_lists):
+        if use_cache:
+            cache_key = get_script_cache_key(script_path.name, script_content)
+            write_cached_response(cache_key, shot_list)
+            embedding = embeddings.get(script_path) if embeddings else None
+            if embedding is not None:
+                add_to_semantic_index(embedding, cache_key)
+        output_path = output_dir / f"{script_path.stem}_shot_list.txt"
+        results.append(await asyncio.to_thread(save_shot_list, shot_list, output_path))
+    return results
+
+
+def process_script_files(client, script_paths, output_dir, use_cache=True,
+                         max_concurrency=MAX_CONCURRENT_REQUESTS):
+    """Process multiple script files and generate shot lists.
+
+    Scripts are sent to Gemini concurrently, up to max_concurrency at a time
+    (set GENAI_CONCURRENCY or --concurrency to change the limit). Consecutive small
+    scripts share one request up to BATCH_TOKEN_BUDGET estimated tokens.
+    """
     if not output_dir.exists():
         output_dir.mkdir(parents=True, exist_ok=True)
         logger.info(f"Created output directory: {output_dir}")
 
-    successful_conversions = 0
     total_files = len(script_paths)
 
+    valid_script_paths = []
     for script_path in script_paths:
         if not script_path.exists():
             logger.warning(f"Script file not found: {script_path}")
@@ -181,23 +878,90 @@ def process_script_files(client, script_paths, output_dir):
             logger.warning(f"Skipping unsupported file type: {script_path}")
             continue
 
-        # Read script content
-        script_content = read_script_file(script_path)
+        valid_script_paths.append(script_path)
+
+    # Read all scripts up front so small ones can be packed into batches.
+    # Scripts with a cached shot list are saved now and left out of the
+    # batches, so one edited script does not regenerate its neighbours.
+    scripts = []
+    cached_conversions = 0
+    for script_path, script_content in zip(
+            valid_script_paths, read_script_files(valid_script_paths)):
         if not script_content:
             logger.warning(f"Empty or unreadable script: {script_path}")
             continue
-
-        # Generate shot list
-        shot_list = generate_shot_list(
-            client, script_content, script_path.name)
-
+        if use_cache:
+            cached = read_cached_response(
+                get_script_cache_key(script_path.name, script_content))
+            if cached:
+                output_path = output_dir / f"{script_path.stem}_shot_list.txt"
+                cached_conversions += save_shot_list(cached, output_path)
+                continue
+        scripts.append((script_path, script_content))
+
+    # Semantic lookups also happen before packing; the embeddings of the
+    # misses are kept so their generated shot lists can be indexed
+    embeddings = {}
+
+    async def embed_script(script_content, semaphore):
+        async with semaphore:
+            return await embed_for_semantic_cache_async(client, script_content)
+
+    async def process_one(script_path, script_content, semaphore):
         # Create output filename
         output_filename = f"{script_path.stem}_shot_list.txt"
         output_path = output_dir / output_filename
 
-        # Save shot list
-        if save_shot_list(shot_list, output_path):
-            successful_conversions += 1
+        # Generate the shot list, streaming it into the output file
+        async with semaphore:
+            return await generate_shot_list_async(
+                client, script_content, script_path.name, output_path, use_cache,
+                use_semantic_cache=False, embedding=embeddings.get(script_path))
+
+    async def process_batch(batch, semaphore):
+        if len(batch) > 1:
+            async with semaphore:
+                results = await generate_shot_list_batch_async(
+                    client, batch, output_dir, use_cache, embeddings)
+            if results is not None:
+                return sum(results)
+            logger.info("Falling back to one request per script")
+        results = await asyncio.gather(
+            *(process_one(script_path, script_content, semaphore)
+              for script_path, script_content in batch))
+        return sum(results)
+
+    async def process_all():
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        pending = scripts
+        semantic_conversions = 0
+        if use_cache and SEMANTIC_CACHE_THRESHOLD is not None:
+            script_embeddings = await asyncio.gather(
+                *(embed_script(script_content, semaphore) for _, script_content in scripts))
+            pending = []
+            for (script_path, script_content), embedding in zip(scripts, script_embeddings):
+                cached = find_semantic_match(embedding) if embedding is not None else None
+                if cached:
+                    output_path = output_dir / f"{script_path.stem}_shot_list.txt"
+                    semantic_conversions += await asyncio.to_thread(
+                        save_shot_list, cached, output_path)
+                    continue
+                embeddings[script_path] = embedding
+                pending.append((script_path, script_content))
+
+        if BATCH_TOKEN_BUDGET > 0:
+            batches = pack_script_batches(pending)
+        else:
+            batches = [[script] for script in pending]
+        if len(batches) < len(pending):
+            logger.info(f"Packed {len(pending)} scripts into {len(batches)} request(s)")
+
+        results = await asyncio.gather(
+            *(process_batch(batch, semaphore) for batch in batches))
+        return semantic_conversions + sum(results)
+
+    successful_conversions = cached_conversions + asyncio.run(process_all())
 
     logger.info(
         f"Conversion complete: {successful_conversions}/{total_files} files processed successfully")
@@ -207,7 +971,7 @@ def natural_sort_key(text):
     """
     Generate a key for natural/alphanumeric sorting.
 
-    This function splits the input string into a list of alternating
+    This function splits the input string into a tuple of alternating
     numeric and non-numeric substrings, so that numbers are compared
     as integers and text as lowercase strings. This ensures that
     filenames like 'chunk_2.txt' are sorted before 'chunk_10.txt'.
@@ -216,18 +980,49 @@ def natural_sort_key(text):
         text (str): The string to generate a sort key for.
 
     Returns:
-        list: A list of elements (int or str) for natural sorting.
+        tuple: (0, str) and (1, int) pairs; the fixed pair shape keeps
+        comparisons on CPython's fast tuple path.
     """
-    def convert(substring):
-        if substring.isdigit(): # If the substring is all digits, convert to int for numeric comparison
-            return int(substring)
-        return substring.lower() # Otherwise, convert to lowercase string for case-insensitive comparison
+    # re.split with a capture group puts the digit runs at odd indices
+    parts = NATURAL_SORT_PATTERN.split(str(text))
+    return tuple((1, int(part)) if index & 1 else (0, part.lower())
+                 for index, part in enumerate(parts))
 
-    parts = re.split(r'(\d+)', str(text)) # Split the text into digit and non-digit parts using regex,
-    return [convert(part) for part in parts] # then convert each part appropriately for sorting
 
+def sort_script_paths(script_paths):
+    """Return script paths in natural order of their file names.
 
-def process_combined_script(client, script_paths, output_dir, combined_script_name):
+    Each key is computed once and sorted alongside its path, so the sort
+    compares plain tuples without calling back into Python per item.
+    """
+    keyed_paths = [(natural_sort_key(path.name), index, path)
+                   for index, path in enumerate(script_paths)]
+    keyed_paths.sort()
+    return [path for _, _, path in keyed_paths]
+
+
+def read_script_files(script_paths):
+    """Read script files concurrently, returning contents in input order"""
+    if not script_paths:
+        return []
+    max_workers = min(MAX_READ_WORKERS, len(script_paths))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(read_script_file, script_paths))
+
+
+def drop_duplicate_chunks(chunks):
+    """Return chunks with byte-identical repeats removed, keeping first occurrences"""
+    seen = set()
+    unique_chunks = []
+    for chunk in chunks:
+        digest = hashlib.sha1(chunk.encode('utf-8')).digest()
+        if digest not in seen:
+            seen.add(digest)
+            unique_chunks.append(chunk)
+    return unique_chunks
+
+
+def process_combined_script(client, script_paths, output_dir, combined_script_name, use_cache=True):
     """Combine multiple script files, generate a single shot list, and save it."""
     if not output_dir.exists():
         output_dir.mkdir(parents=True, exist_ok=True)
@@ -238,14 +1033,17 @@ def process_combined_script(client, script_paths, output_dir, combined_script_na
     logger.info("Combining multiple script files into one.")
 
     # Sort files using natural sorting to handle chunk_0001, chunk_0002, etc.
-    sorted_script_paths = sorted(script_paths, key=lambda x: natural_sort_key(x.name))
+    sorted_script_paths = sort_script_paths(script_paths)
 
-    logger.info("Script files will be combined in this order:")
-    for i, script_path in enumerate(sorted_script_paths, 1):
-        logger.info(f"  {i}. {script_path.name}")
+    # One multi-line record instead of one per file
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Script files will be combined in this order:\n" + "\n".join(
+            f"  {i}. {script_path.name}"
+            for i, script_path in enumerate(sorted_script_paths, 1)))
 
-    for script_path in sorted_script_paths:
-        content = read_script_file(script_path)
+    # Reads and RTF conversion overlap across threads; map keeps the order
+    contents = read_script_files(sorted_script_paths)
+    for script_path, content in zip(sorted_script_paths, contents):
         if content:
             full_script_content.append(content)
         else:
@@ -256,38 +1054,140 @@ def process_combined_script(client, script_paths, output_dir, combined_script_na
         logger.error("No content found in script files to combine.")
         return
 
-    combined_content = "\n\n".join(full_script_content)
+    # Identical chunks (repeated headers, re-exported scripts) only add tokens
+    unique_script_content = drop_duplicate_chunks(full_script_content)
+    duplicate_count = len(full_script_content) - len(unique_script_content)
+    if duplicate_count:
+        logger.info(
+            f"Dropped {duplicate_count} duplicate script chunk(s) before combining")
 
-    # Generate shot list for the combined script
-    shot_list = generate_shot_list(
-        client, combined_content, f"{combined_script_name} (Combined)")
+    combined_content = "\n\n".join(unique_script_content)
 
     # Create output filename
     output_filename = f"{combined_script_name}_combined_shot_list.txt"
     output_path = output_dir / output_filename
 
-    # Save shot list
-    if save_shot_list(shot_list, output_path):
+    # Generate the shot list for the combined script, streaming it to disk.
+    # Combined scripts are far past the embedding input limit, so only the
+    # exact cache applies.
+    if asyncio.run(generate_shot_list_async(
+            client, combined_content, f"{combined_script_name} (Combined)",
+            output_path, use_cache, use_semantic_cache=False)):
         logger.info(f"Combined shot list saved to: {output_path}")
 
     logger.info("Combined script processing complete.")
 
 
+def is_script_size_ok(path, size):
+    """Return False (with a log message) for empty or oversized script files"""
+    if size == 0:
+        logger.info(f"Skipping empty script: {path}")
+        return False
+    if size > MAX_SCRIPT_BYTES:
+        logger.warning(
+            f"Skipping script larger than {MAX_SCRIPT_BYTES} bytes ({size} bytes): {path}")
+        return False
+    return True
+
+
+def scan_script_files(directory):
+    """Recursively collect .txt and .rtf files under directory in one os.scandir walk.
+
+    DirEntry objects carry the file type from the directory listing, so
+    only matching files are turned into Path objects. Empty and oversized
+    files are dropped here, before anything reads them.
+    """
+    script_files = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    script_files.extend(scan_script_files(entry.path))
+                elif (entry.name.lower().endswith(SCRIPT_EXTENSIONS) and entry.is_file()
+                      and is_script_size_ok(entry.path, entry.stat().st_size)):
+                    script_files.append(Path(entry.path))
+    except OSError as e:
+        logger.warning(f"Could not scan directory {directory}: {e}")
+    return script_files
+
+
 def find_script_files(directory):
     """Find all .txt and .rtf files in directory and subdirectories"""
-    if directory.is_file() and directory.suffix.lower() in ['.txt', '.rtf']:
-        return [directory]
+    if directory.is_file() and directory.suffix.lower() in SCRIPT_EXTENSIONS:
+        if is_script_size_ok(directory, directory.stat().st_size):
+            return [directory]
+        return []
 
     if directory.is_dir():
-        txt_files = list(directory.rglob('*.txt'))
-        rtf_files = list(directory.rglob('*.rtf'))
-        return txt_files + rtf_files
+        return scan_script_files(directory)
 
     return []
 
 
-def get_user_inputs():
-    """Get user inputs through interactive prompts"""
+def existing_path(value):
+    """argparse type that accepts only paths that exist"""
+    path = Path(value)
+    if not path.exists():
+        raise argparse.ArgumentTypeError(f"Input path does not exist: {value}")
+    return path
+
+
+def positive_int(value):
+    """argparse type that accepts only whole numbers of at least 1"""
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be a whole number of at least 1: {value}")
+    return number
+
+
+def parse_args():
+    """Parse command line arguments; anything omitted is asked interactively"""
+    parser = argparse.ArgumentParser(
+        description="Convert film scripts (.txt/.rtf) into detailed shot lists with Gemini")
+    parser.add_argument(
+        '--input', dest='input_path', type=existing_path,
+        help="Script file or directory containing scripts (.txt/.rtf)")
+    parser.add_argument(
+        '--output-dir', help="Output directory for shot lists (default: text_files/shot_lists)")
+    parser.add_argument(
+        '--combine', action=argparse.BooleanOptionalAction,
+        help="Combine a directory of scripts into a single shot list (default: combine)")
+    parser.add_argument(
+        '--concurrency', type=positive_int,
+        help=f"Maximum Gemini requests in flight at once (default: {MAX_CONCURRENT_REQUESTS})")
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help="Ignore cached Gemini responses and always call the API")
+    parser.add_argument(
+        '--verbose', action='store_true', help="Enable verbose logging")
+    args = parser.parse_args()
+    if args.input_path is None and not sys.stdin.isatty():
+        parser.error("--input is required when not running in a terminal")
+    return args
+
+
+def get_user_inputs(args):
+    """Get user inputs, prompting interactively for anything not given on the command line.
+
+    When --input is given the run is treated as scripted: optional settings
+    fall back to their defaults instead of being asked for.
+    """
+    interactive = args.input_path is None
+    answers = {
+        'interactive': interactive,
+        'input_path': args.input_path,
+        'output_dir': args.output_dir or "text_files/shot_lists",
+        'use_cache': not args.no_cache,
+        'verbose': args.verbose,
+    }
+    if not interactive:
+        return answers
+
+    import inquirer
+
     print("Film Script to Shot List Generator")
     print("Supports .txt and .rtf files with Chinese content")
     print("=" * 60)
@@ -299,23 +1199,34 @@ def get_user_inputs():
             path_type=inquirer.Path.ANY,
             exists=True,
         ),
-        inquirer.Text(
+    ]
+    if args.output_dir is None:
+        questions.append(inquirer.Text(
             'output_dir',
             message="Output directory for shot lists",
             default="text_files/shot_lists"
-        ),
-        inquirer.Confirm(
+        ))
+    if not args.no_cache:
+        questions.append(inquirer.Confirm(
+            'use_cache',
+            message="Reuse cached Gemini responses for unchanged scripts?",
+            default=True
+        ))
+    if not args.verbose:
+        questions.append(inquirer.Confirm(
             'verbose',
             message="Enable verbose logging?",
             default=False
-        )
-    ]
+        ))
 
-    answers = inquirer.prompt(questions)
-    if not answers:
+    prompted = inquirer.prompt(questions)
+    if not prompted:
         print("Operation cancelled.")
         sys.exit(0)
 
+    answers.update(prompted)
+    # Strip spaces, single quotes, and double quotes from the typed path
+    answers['input_path'] = Path(answers['input_path'].strip().strip("'\""))
     return answers
 
 
@@ -324,6 +1235,13 @@ def get_api_key_if_needed():
     api_key = os.getenv('GEMINI_API_KEY') or os.getenv('GOOGLE_API_KEY')
 
     if not api_key:
+        if not sys.stdin.isatty():
+            print(
+                "Please set GEMINI_API_KEY or GOOGLE_API_KEY environment variable and try again.")
+            sys.exit(1)
+
+        import inquirer
+
         print("\nAPI Key Required")
         print("No Gemini API key found in environment variables.")
 
@@ -352,19 +1270,16 @@ def get_api_key_if_needed():
 
 
 def main():
-    """Main function with interactive prompts"""
+    """Main function with command line arguments and interactive prompts"""
     try:
-        # Get user inputs interactively
-        inputs = get_user_inputs()
+        # Get user inputs from the command line, prompting for the rest
+        args = parse_args()
+        inputs = get_user_inputs(args)
 
         if inputs['verbose']:
             logging.getLogger().setLevel(logging.DEBUG)
 
-        # Validate input path
-        raw_input_path = inputs['input_path']
-        # Strip spaces, single quotes, and double quotes
-        cleaned_input_path = raw_input_path.strip().strip("'\"")
-        input_path = Path(cleaned_input_path)
+        input_path = inputs['input_path']
         if not input_path.exists():
             logger.error(f"Input path does not exist: {input_path}")
             sys.exit(1)
@@ -378,13 +1293,17 @@ def main():
             sys.exit(1)
 
         print(f"\nFound {len(script_files)} script file(s) to process:")
-        for i, file_path in enumerate(script_files, 1):
-            print(f"  {i}. {file_path.name}")
+        print("\n".join(f"  {i}. {file_path.name}"
+                        for i, file_path in enumerate(script_files, 1)))
         print("\n")
 
         # Ask about combining if multiple files are in a directory
         combine_files = False
         if input_path.is_dir() and len(script_files) > 1:
+            combine_files = args.combine
+        if combine_files is None and inputs['interactive']:
+            import inquirer
+
             combine_question = [
                 inquirer.Confirm(
                     'combine',
@@ -396,8 +1315,9 @@ def main():
             if not answers:
                 print("Operation cancelled.")
                 sys.exit(0)
-            if answers['combine']:
-                combine_files = True
+            combine_files = answers['combine']
+        elif combine_files is None:
+            combine_files = True
 
         # Get API key if needed
         api_key = get_api_key_if_needed()
@@ -430,10 +1350,13 @@ def main():
             print(f"\nCombining scripts and generating a single shot list...")
             combined_script_name = input_path.name
             process_combined_script(
-                client, script_files, output_dir, combined_script_name)
+                client, script_files, output_dir, combined_script_name,
+                inputs['use_cache'])
         else:
             print(f"\nProcessing text files individually...")
-            process_script_files(client, script_files, output_dir)
+            process_script_files(
+                client, script_files, output_dir, inputs['use_cache'],
+                args.concurrency or MAX_CONCURRENT_REQUESTS)
 
         print(f"\nShot lists saved to: {output_dir.absolute()}")
 
@@ -442,8 +1365,7 @@ def main():
         output_files = list(output_dir.glob(output_glob))
         if output_files:
             print(f"\nGenerated shot lists:")
-            for output_file in output_files:
-                print(f"{output_file.name}")
+            print("\n".join(output_file.name for output_file in output_files))
 
     except KeyboardInterrupt:
         print("\n\nOperation cancelled by user.")
@@ -1,10 +1,17 @@
+import asyncio
+import hashlib
+import io
 import logging
 import os
+import random
 import sys
+import threading
+import time
 import re
 from pathlib import Path
 from google import genai
-from google.genai import types
+from google.genai import errors, types
+import httpx
 from dotenv import load_dotenv
 import inquirer
 
@@ -18,48 +25,98 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Gemini generation settings (also part of the response cache key)
+GEMINI_MODEL = 'gemini-2.5-pro'  # Using a generally available and capable model
+TEMPERATURE = 0.7
+
+# SYSTEM_PROMPT and the character descriptions are uploaded once as Gemini
+# cached content and referenced by name; the handle is kept for this long
+PROMPT_CACHE_TTL = '3600s'
+# Gemini rejects cached content below this many tokens for GEMINI_MODEL, so
+# smaller prompt prefixes are always sent inline
+PROMPT_CACHE_MIN_TOKENS = 4096
+
+
+def get_concurrency_from_env(default=8):
+    """Return GENAI_CONCURRENCY as an integer of at least 1, or default if unset or invalid"""
+    value = os.getenv('GENAI_CONCURRENCY')
+    if value is None:
+        return default
+    try:
+        concurrency = int(value)
+    except ValueError:
+        concurrency = 0
+    if concurrency < 1:
+        # A semaphore of 0 would never let a request through
+        logger.warning(
+            f"GENAI_CONCURRENCY must be a whole number of at least 1, got {value!r}; using {default}")
+        return default
+    return concurrency
+
+
+# Maximum number of Gemini requests allowed in flight at once
+MAX_CONCURRENT_REQUESTS = get_concurrency_from_env()
+
+# Rate-limited, timed-out and server-side failures are retried with
+# exponential backoff and jitter, at most this many attempts per request
+MAX_ATTEMPTS = 5
+RETRY_MAX_DELAY = 30
+RETRYABLE_STATUS_CODES = frozenset((408, 429))
+
+# Splits file names into digit and non-digit runs for natural sorting
+NATURAL_SORT_PATTERN = re.compile(r'(\d+)')
+
+# Cached Gemini responses live here unless STORYBOARD_GEN_CACHE_DIR is set
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "storyboard_gen"
+
+# Batch jobs are billed at about half the interactive rate but complete
+# asynchronously, so they are only offered for at least this many files
+BATCH_MIN_FILES = 2
+# Seconds between status checks while waiting for a batch job
+BATCH_POLL_INTERVAL = 30
+# Give up (and cancel the job) after this many seconds; Gemini expires
+# batch jobs that are still pending or running after 48 hours anyway
+BATCH_MAX_WAIT = 48 * 60 * 60
+BATCH_DONE_STATES = frozenset((
+    'JOB_STATE_SUCCEEDED', 'JOB_STATE_FAILED',
+    'JOB_STATE_CANCELLED', 'JOB_STATE_EXPIRED',
+))
+
 # System prompt for Imagen prompt generation
 SYSTEM_PROMPT = """You are a professional prompt engineer specializing in image generation for film and cinematography. Convert the provided shot list into detailed Imagen prompts that will generate high-quality cinematic images.
 
-You will be provided with:
-1. Character descriptions (if available) to ensure consistency across all generated images
-2. A shot list to convert into image prompts
-
-For each shot in the shot list, create a comprehensive Imagen prompt that includes:
-1. Scene setting and environment details
-2. Character descriptions and positioning (use the provided character descriptions for consistency)
-3. Camera angle and framing (translated to visual perspective)
-4. Lighting conditions and mood
-5. Technical visual elements (depth of field, composition, etc.)
-6. Artistic style and cinematic quality descriptors
-7. The color palette of the shots needs to be distinct between cold and warm colors, depending on the year and location of the story being told, for example:
-- before 1940s in china, the Li Huan Ying was studying in the US, which uses warm colors to emphasize her student life in the US and her social status. 
-- The color turns cold when she is back in China during the 1940s and 1950s.
-- The colors are expecially cold and gray between 1969 and 1973 when her life is at the lowest point.
-- Every time she is not in China, execpt for USSR, the colors are warm and bright.
-- Every time she is in Beijing, the color is less cold, to give more hope and utopian feel.
-- She is a bit lost before 1978 and the color should reflect that.
-- She becames more busy at her work starting from 1979, which began to change her life for the better, and the color should reflect that.
+Input: character descriptions (if available, for consistency across all images) and a shot list.
+
+For each shot, write a prompt covering:
+1. Scene setting and environment
+2. Characters and positioning (per the character descriptions)
+3. Camera angle and framing as visual perspective
+4. Lighting and mood
+5. Technical visuals (depth of field, composition)
+6. Artistic style and cinematic quality
+7. Color palette, warm or cold by the year and location of Li Huan Ying's story:
+Before 1940s (student in the US): warm, showing her student life and social status
+1940s-1950s (back in China): cold
+1969-1973 (her lowest point): especially cold and gray
+Before 1978: muted, she is a bit lost
+1979 onward (busy at work, life improving): progressively warmer
+Any year, outside China except USSR: warm and bright
+Any year, in Beijing: less cold, hopeful and utopian
 
 Guidelines for Imagen prompts:
 - **Core Prompting Formula:** Use the format: `[Subject]`, `[Style]`, `[Setting]`, `[Lighting/Camera Modifiers]`. Be specific and descriptive for the best results.
 - **Example of a strong, detailed prompt:** "A hyperrealistic, highly detailed photograph, medium close-up shot of an elderly sailor with a weathered face, a thick white beard, and deep-set, thoughtful eyes, wearing a heavy navy blue wool sweater. He is on the deck of a wooden ship, bracing against the wind during a storm. The setting is a tumultuous sea with massive, churning waves crashing against the hull under dark, dramatic storm clouds. The lighting is Rembrandt-style side lighting, casting strong shadows and highlighting the texture of his skin, sharp focus."
 
-- Be specific about visual details, lighting, and composition.
-- The prompts should be in photorealism cinematic style with high contrast and cinematic lighting.
-- Include camera terms translated to visual perspective (e.g., "wide shot" becomes "wide angle view").
-- Describe the mood and atmosphere.
-- Add technical photography terms for better results.
+- Be specific about visual details, lighting, composition, mood and atmosphere.
+- Photorealistic cinematic style, high contrast, cinematic lighting.
+- Translate camera terms to visual perspective (e.g., "wide shot" becomes "wide angle view").
+- Use cinematic and technical photography terminology.
 - Keep each prompt focused and detailed but concise.
-- Use cinematic and photographic terminology.
-- Include aspect ratio suggestions when relevant.
-- The character's clothing should match the time period, location, and season of the story and shots.
-- The props in the shot's prompt should match the time period, location, and season of the story and shots.
-- The vehicles in the shot's prompt should match the time period, location, and season of the story and shots.
-- The location in the shot's prompt should match the time period, country, and season of the story and shots.
-- **IMPORTANT:** Use the provided character descriptions consistently across all prompts to maintain visual continuity, but account for character aging and changes in appearance over time.
+- Suggest an aspect ratio when relevant.
+- Clothing, props, vehicles, and locations must match the story's period, country, and season.
+- **IMPORTANT:** Use the character descriptions consistently for visual continuity, but account for aging and changes in appearance over time.
 
-Format the output as numbered prompts corresponding to each shot:
+Output one numbered prompt per shot:
 
 SCENE 1 - SHOT 1A: KITCHEN - MORNING 1999
 Imagen Prompt: "Cinematic wide angle view of a quintessential 1990s kitchen, featuring oak cabinets, a subtle patterned linoleum floor, and a box of cereal on the formica countertop. The room is bathed in warm, golden morning sunlight streaming through a large window over the sink, illuminating dust motes dancing in the air. A young woman in an oversized flannel shirt and jeans enters from the left, her face lit with a bright, genuinely excited smile as if greeting a loved one. The aesthetic is hyper-realistic film photography, with a shallow depth of field, a warm and slightly faded color palette, professional cinematography, and authentic 35mm film grain, captured in a 16:9 aspect ratio."
@@ -71,11 +128,144 @@ Convert the following shot list:
 """
 
 
+# Name of the cached content holding SYSTEM_PROMPT and the character
+# descriptions, or None to send both inline
+prompt_cache_name = None
+# Set once the first request has decided whether to use the prompt cache
+prompt_cache_ready = False
+prompt_cache_lock = threading.Lock()
+
+
 def create_gemini_client(api_key):
     """Create and return a Gemini API client"""
     return genai.Client(api_key=api_key)
 
 
+def is_prompt_cacheable(client, characters_content):
+    """Return True if the prompt prefix reaches PROMPT_CACHE_MIN_TOKENS"""
+    # A token covers at least one character, so a shorter prefix is
+    # rejected without a count_tokens round-trip
+    if len(SYSTEM_PROMPT) + len(characters_content) < PROMPT_CACHE_MIN_TOKENS:
+        return False
+    try:
+        result = client.models.count_tokens(
+            model=GEMINI_MODEL,
+            contents=[SYSTEM_PROMPT, f"CHARACTER DESCRIPTIONS:\n{characters_content}"])
+        return result.total_tokens >= PROMPT_CACHE_MIN_TOKENS
+    except Exception as e:
+        logger.warning(f"Could not count prompt tokens, sending system prompt inline: {e}")
+        return False
+
+
+def ensure_prompt_cache(client, characters_content):
+    """Create the prompt cache before the first Gemini request of the run.
+
+    Runs only once, and only when a request is actually sent, so runs served
+    entirely from the response cache make no extra API calls. Safe to call
+    from several worker threads at once.
+    """
+    global prompt_cache_ready
+    with prompt_cache_lock:
+        if prompt_cache_ready:
+            return
+        prompt_cache_ready = True
+        if is_prompt_cacheable(client, characters_content):
+            create_prompt_cache(client, characters_content)
+        else:
+            logger.info("Prompt prefix is below the minimum cacheable size, sending it inline")
+
+
+def delete_prompt_cache(client):
+    """Delete the prompt cache so its storage is not billed until the TTL runs out"""
+    global prompt_cache_name
+    if not prompt_cache_name:
+        return
+    try:
+        client.caches.delete(name=prompt_cache_name)
+        logger.info(f"Deleted prompt cache: {prompt_cache_name}")
+    except Exception as e:
+        logger.warning(f"Could not delete prompt cache {prompt_cache_name}: {e}")
+    prompt_cache_name = None
+
+
+def refresh_prompt_cache(client, characters_content, expired_name):
+    """Recreate the prompt cache after expired_name expired.
+
+    Concurrent requests can all hit the expired cache at once; only the
+    first to take the lock recreates it and the rest use its replacement.
+    """
+    with prompt_cache_lock:
+        if prompt_cache_name == expired_name:
+            create_prompt_cache(client, characters_content)
+
+
+def create_prompt_cache(client, characters_content):
+    """Create the Gemini cached content holding SYSTEM_PROMPT and characters.txt.
+
+    On any failure requests fall back to sending the system instruction
+    and character descriptions inline. Callers hold prompt_cache_lock.
+    """
+    global prompt_cache_name
+    try:
+        cache = client.caches.create(
+            model=GEMINI_MODEL,
+            config=types.CreateCachedContentConfig(
+                system_instruction=SYSTEM_PROMPT,
+                contents=[f"CHARACTER DESCRIPTIONS:\n{characters_content}"]
+                if characters_content else None,
+                ttl=PROMPT_CACHE_TTL,
+            )
+        )
+        prompt_cache_name = cache.name
+        logger.info(f"Cached system prompt and character descriptions as: {cache.name}")
+    except Exception as e:
+        prompt_cache_name = None
+        logger.warning(
+            f"Context caching unavailable, sending system prompt inline: {e}")
+
+
+def get_finish_reason(response):
+    """Return the finish reason name of a response or streamed chunk, or None"""
+    if response is None or not response.candidates:
+        return None
+    finish_reason = response.candidates[0].finish_reason
+    return getattr(finish_reason, 'name', finish_reason)
+
+
+def is_missing_cache_error(error, cache_name):
+    """Return True if a request using cache_name failed because the cache expired"""
+    return cache_name is not None and getattr(error, 'code', None) == 404
+
+
+def is_retryable_error(error):
+    """Return True for rate limits, timeouts and server errors worth retrying"""
+    if isinstance(error, (errors.ServerError, httpx.TimeoutException, httpx.NetworkError)):
+        return True
+    return getattr(error, 'code', None) in RETRYABLE_STATUS_CODES
+
+
+def get_retry_delay(attempt):
+    """Return the backoff delay in seconds before retrying after the given attempt"""
+    return min(RETRY_MAX_DELAY, 2 ** attempt + random.random())
+
+
+async def run_with_retries_async(description, request):
+    """Await request(), retrying transient errors with backoff"""
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            return await request()
+        except Exception as e:
+            if attempt == MAX_ATTEMPTS:
+                raise
+            if is_retryable_error(e):
+                delay = get_retry_delay(attempt)
+                logger.warning(
+                    f"Attempt {attempt} for {description} failed ({e}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+            else:
+                raise
+
+
 def read_characters_file(base_dir="text_files"):
     """Read the characters.txt file and return its content"""
     characters_path = Path(base_dir) / "characters.txt"
@@ -121,69 +311,291 @@ def read_shot_list_file(file_path):
         return ""
 
 
-def generate_image_prompts(client, shot_list_content, shot_list_name):
-    """Generate image prompts from shot list content using Gemini API"""
+async def read_shot_list_file_async(file_path):
+    """Read a shot list file on a worker thread so the event loop keeps serving requests"""
+    return await asyncio.to_thread(read_shot_list_file, file_path)
+
+
+def get_cache_dir():
+    """Return the directory used for cached Gemini responses"""
+    return Path(os.getenv('STORYBOARD_GEN_CACHE_DIR', DEFAULT_CACHE_DIR))
+
+
+def get_cache_key(shot_list_content, shot_list_name, characters_content):
+    """Hash the generation settings and request content into a cache key"""
+    key_source = (f"{GEMINI_MODEL}|{TEMPERATURE}|{SYSTEM_PROMPT}|{characters_content}|"
+                  f"{shot_list_name}|{shot_list_content}")
+    return hashlib.blake2b(key_source.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def read_cached_response(cache_key):
+    """Return a cached Gemini response, or None if there is no cache entry"""
+    cache_path = get_cache_dir() / f"{cache_key}.txt"
     try:
-        # Read character descriptions
-        characters_content = read_characters_file()
+        if cache_path.exists():
+            logger.info(f"Using cached Gemini response: {cache_path.name}")
+            return cache_path.read_text(encoding='utf-8')
+    except Exception as e:
+        logger.warning(f"Could not read cached response {cache_path}: {e}")
+    return None
 
-        # Construct the user content with both characters and shot list
-        if characters_content:
-            user_content = f"CHARACTER DESCRIPTIONS:\n{characters_content}\n\nSHOT LIST: {shot_list_name}\n\n{shot_list_content}"
-            logger.info(
-                f"Including character descriptions in prompt for: {shot_list_name}")
-        else:
-            user_content = f"SHOT LIST: {shot_list_name}\n\n{shot_list_content}"
-            logger.info(
-                f"No character descriptions found, proceeding with shot list only for: {shot_list_name}")
 
-        logger.info(f"Generating image prompts for: {shot_list_name}")
+def write_cached_response(cache_key, response_text):
+    """Store a Gemini response in the cache, replacing any entry atomically"""
+    cache_dir = get_cache_dir()
+    cache_path = cache_dir / f"{cache_key}.txt"
+    tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path.write_text(response_text, encoding='utf-8')
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        logger.warning(f"Could not write cached response {cache_path}: {e}")
+        tmp_path.unlink(missing_ok=True)
 
-        response = client.models.generate_content(
-            model='gemini-2.5-pro',  # Using a generally available and capable model
-            contents=user_content,
-            config=types.GenerateContentConfig(
-                system_instruction=SYSTEM_PROMPT,
-                temperature=0.7,
-            )
+
+def build_generation_config():
+    """Return the generation config, referencing the cached prompt prefix if any"""
+    if prompt_cache_name:
+        return types.GenerateContentConfig(
+            cached_content=prompt_cache_name,
+            temperature=TEMPERATURE,
         )
+    return types.GenerateContentConfig(
+        system_instruction=SYSTEM_PROMPT,
+        temperature=TEMPERATURE,
+    )
 
-        if response and response.text:
-            logger.info(
-                f"Successfully generated image prompts for: {shot_list_name}")
-            return response.text
-        else:
-            logger.error(
-                f"Empty or blocked response from Gemini for: {shot_list_name}. Response: {response}")
-            return f"Error: Could not generate image prompts for {shot_list_name}. The response was empty or blocked."
 
+def build_user_content(shot_list_content, shot_list_name, characters_content,
+                       use_prompt_cache=True):
+    """Build the request text for a shot list, with character descriptions if available"""
+    # Character descriptions are already part of the cached prompt prefix
+    if use_prompt_cache and prompt_cache_name:
+        return f"SHOT LIST: {shot_list_name}\n\n{shot_list_content}"
+
+    # Construct the user content with both characters and shot list
+    if characters_content:
+        logger.info(
+            f"Including character descriptions in prompt for: {shot_list_name}")
+        return f"CHARACTER DESCRIPTIONS:\n{characters_content}\n\nSHOT LIST: {shot_list_name}\n\n{shot_list_content}"
+
+    logger.info(
+        f"No character descriptions found, proceeding with shot list only for: {shot_list_name}")
+    return f"SHOT LIST: {shot_list_name}\n\n{shot_list_content}"
+
+
+async def request_image_prompts_async(client, shot_list_content, shot_list_name,
+                                      characters_content):
+    """Send one image prompt request, recreating the prompt cache if it expired"""
+    config = build_generation_config()
+    try:
+        return await client.aio.models.generate_content(
+            model=GEMINI_MODEL,
+            contents=build_user_content(
+                shot_list_content, shot_list_name, characters_content),
+            config=config
+        )
+    except Exception as e:
+        if not is_missing_cache_error(e, config.cached_content):
+            raise
+
+    logger.info("Prompt cache expired, recreating it")
+    await asyncio.to_thread(
+        refresh_prompt_cache, client, characters_content, config.cached_content)
+    return await client.aio.models.generate_content(
+        model=GEMINI_MODEL,
+        contents=build_user_content(
+            shot_list_content, shot_list_name, characters_content),
+        config=build_generation_config()
+    )
+
+
+async def generate_image_prompts_async(client, shot_list_content, shot_list_name,
+                                       characters_content, use_cache=True):
+    """Generate image prompts from shot list content using Gemini API.
+
+    Returns the image prompts, or None if they could not be generated.
+    """
+    cache_key = get_cache_key(shot_list_content, shot_list_name, characters_content)
+    if use_cache:
+        cached = await asyncio.to_thread(read_cached_response, cache_key)
+        if cached:
+            return cached
+
+    try:
+        logger.info(f"Generating image prompts for: {shot_list_name}")
+        await asyncio.to_thread(ensure_prompt_cache, client, characters_content)
+        response = await run_with_retries_async(
+            shot_list_name,
+            lambda: request_image_prompts_async(
+                client, shot_list_content, shot_list_name, characters_content))
     except Exception as e:
         logger.error(
             f"Error generating image prompts for {shot_list_name}: {e}")
-        return f"Error generating image prompts for {shot_list_name}: {str(e)}"
+        return None
+
+    if not response or not response.text:
+        logger.error(
+            f"Empty or blocked response from Gemini for: {shot_list_name}. Response: {response}")
+        return None
+
+    # Prompts cut off at the output limit or stopped by a safety filter
+    # are incomplete; caching them would replay the failure on every run
+    finish_reason = get_finish_reason(response)
+    if finish_reason != 'STOP':
+        logger.error(
+            f"Gemini response for {shot_list_name} ended with finish reason {finish_reason}")
+        return None
+
+    logger.info(
+        f"Successfully generated image prompts for: {shot_list_name}")
+    image_prompts = response.text
+    if use_cache:
+        await asyncio.to_thread(
+            write_cached_response, cache_key, image_prompts)
+    return image_prompts
 
 
 def save_image_prompts(prompts, output_path):
-    """Save image prompts to file"""
+    """Save image prompts to file, replacing any existing file atomically.
+
+    The text is encoded once and written with a single call to a temporary
+    file, so an interrupted run never leaves a partial prompt file behind.
+    """
+    tmp_path = output_path.with_suffix(f".{os.getpid()}.tmp")
     try:
-        with open(output_path, 'w', encoding='utf-8') as file:
-            file.write(prompts)
+        tmp_path.write_bytes(prompts.encode('utf-8'))
+        os.replace(tmp_path, output_path)
         logger.info(f"Image prompts saved to: {output_path}")
         return True
     except Exception as e:
         logger.error(f"Error saving image prompts to {output_path}: {e}")
+        tmp_path.unlink(missing_ok=True)
         return False
 
 
-def process_shot_list_files(client, shot_list_paths, output_dir):
-    """Process multiple shot list files and generate image prompts"""
-    if not output_dir.exists():
-        output_dir.mkdir(parents=True, exist_ok=True)
-        logger.info(f"Created output directory: {output_dir}")
+def wait_for_batch_job(client, job):
+    """Poll a Gemini batch job until it reaches a final state and return it.
+
+    The job is cancelled if it is still running after BATCH_MAX_WAIT
+    seconds or if polling is interrupted with Ctrl-C, so an abandoned run
+    does not keep a billed job going.
+    """
+    deadline = time.monotonic() + BATCH_MAX_WAIT
+    try:
+        while job.state.name not in BATCH_DONE_STATES:
+            if time.monotonic() >= deadline:
+                logger.error(
+                    f"Batch job {job.name} still {job.state.name} after {BATCH_MAX_WAIT}s, cancelling it")
+                client.batches.cancel(name=job.name)
+                return client.batches.get(name=job.name)
+            logger.info(f"Batch job {job.name} is {job.state.name}, checking again in {BATCH_POLL_INTERVAL}s")
+            time.sleep(BATCH_POLL_INTERVAL)
+            job = client.batches.get(name=job.name)
+    except KeyboardInterrupt:
+        logger.info(f"Cancelling batch job {job.name}")
+        client.batches.cancel(name=job.name)
+        raise
+    return job
 
+
+def process_shot_list_files_batch(client, shot_list_paths, output_dir, characters_content,
+                                  use_cache=True):
+    """Submit every shot list as one Gemini batch job and save the results.
+
+    Requests are sent inline with the job rather than as an uploaded JSONL
+    file; shot lists are small text, well within the inline size limit.
+    Shot lists with a cached response are saved from the cache and left
+    out of the job.
+
+    Returns:
+        int: The number of image prompt files saved.
+    """
     successful_conversions = 0
+    requests = []
+    request_paths = []
+    request_cache_keys = []
+    for shot_list_path in shot_list_paths:
+        shot_list_content = read_shot_list_file(shot_list_path)
+        if not shot_list_content:
+            logger.warning(f"Empty or unreadable shot list: {shot_list_path}")
+            continue
+
+        cache_key = get_cache_key(
+            shot_list_content, shot_list_path.name, characters_content)
+        if use_cache:
+            cached = read_cached_response(cache_key)
+            if cached:
+                output_path = output_dir / f"{shot_list_path.stem}_image_prompts.txt"
+                if save_image_prompts(cached, output_path):
+                    successful_conversions += 1
+                continue
+
+        # Batch jobs can outlive the prompt cache, and the SDK serializes an
+        # inlined system_instruction outside the request where the API
+        # ignores it, so SYSTEM_PROMPT travels in the contents instead
+        user_content = build_user_content(
+            shot_list_content, shot_list_path.name, characters_content,
+            use_prompt_cache=False)
+        requests.append(types.InlinedRequest(
+            contents=f"{SYSTEM_PROMPT}\n\n{user_content}",
+            config=types.GenerateContentConfig(temperature=TEMPERATURE),
+        ))
+        request_paths.append(shot_list_path)
+        request_cache_keys.append(cache_key)
+
+    if not requests:
+        return successful_conversions
+
+    job = client.batches.create(
+        model=GEMINI_MODEL,
+        src=requests,
+        config=types.CreateBatchJobConfig(
+            display_name=f"shots2prompts-{output_dir.name}"),
+    )
+    logger.info(f"Submitted batch job {job.name} with {len(requests)} shot lists")
+
+    job = wait_for_batch_job(client, job)
+    if job.state.name != 'JOB_STATE_SUCCEEDED':
+        logger.error(f"Batch job {job.name} ended in state {job.state.name}: {job.error}")
+        return successful_conversions
+
+    # Inline responses come back in the same order as the requests
+    for shot_list_path, cache_key, inlined_response in zip(
+            request_paths, request_cache_keys, job.dest.inlined_responses):
+        response = inlined_response.response
+        if not response or not response.text:
+            logger.error(
+                f"No image prompts returned for {shot_list_path.name}: {inlined_response.error}")
+            continue
+        finish_reason = get_finish_reason(response)
+        if finish_reason != 'STOP':
+            logger.error(
+                f"Image prompts for {shot_list_path.name} ended with finish reason {finish_reason}")
+            continue
+
+        if use_cache:
+            write_cached_response(cache_key, response.text)
+        output_path = output_dir / f"{shot_list_path.stem}_image_prompts.txt"
+        if save_image_prompts(response.text, output_path):
+            successful_conversions += 1
+
+    return successful_conversions
+
+
+def process_shot_list_files(client, shot_list_paths, output_dir, characters_content="",
+                            use_batch=False, use_cache=True):
+    """Process multiple shot list files and generate image prompts.
+
+    Interactive requests run concurrently, up to MAX_CONCURRENT_REQUESTS at
+    a time (set GENAI_CONCURRENCY to change the limit). With use_batch, runs
+    of at least BATCH_MIN_FILES files are submitted as a single Gemini batch
+    job instead.
+    """
     total_files = len(shot_list_paths)
 
+    valid_shot_list_paths = []
     for shot_list_path in shot_list_paths:
         if not shot_list_path.exists():
             logger.warning(f"Shot list file not found: {shot_list_path}")
@@ -193,23 +605,44 @@ def process_shot_list_files(client, shot_list_paths, output_dir):
             logger.warning(f"Skipping non-txt file: {shot_list_path}")
             continue
 
-        # Read shot list content
-        shot_list_content = read_shot_list_file(shot_list_path)
+        valid_shot_list_paths.append(shot_list_path)
+
+    if use_batch and len(valid_shot_list_paths) >= BATCH_MIN_FILES:
+        successful_conversions = process_shot_list_files_batch(
+            client, valid_shot_list_paths, output_dir, characters_content, use_cache)
+        logger.info(
+            f"Conversion complete: {successful_conversions}/{total_files} files processed successfully")
+        return
+
+    async def process_one(shot_list_path, semaphore):
+        # Read shot list content without blocking other requests
+        shot_list_content = await read_shot_list_file_async(shot_list_path)
         if not shot_list_content:
             logger.warning(f"Empty or unreadable shot list: {shot_list_path}")
-            continue
+            return False
 
         # Generate image prompts
-        image_prompts = generate_image_prompts(
-            client, shot_list_content, shot_list_path.name)
+        async with semaphore:
+            image_prompts = await generate_image_prompts_async(
+                client, shot_list_content, shot_list_path.name, characters_content,
+                use_cache)
+        if image_prompts is None:
+            return False
 
         # Create output filename
         output_filename = f"{shot_list_path.stem}_image_prompts.txt"
         output_path = output_dir / output_filename
 
         # Save image prompts
-        if save_image_prompts(image_prompts, output_path):
-            successful_conversions += 1
+        return await asyncio.to_thread(save_image_prompts, image_prompts, output_path)
+
+    async def process_all():
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        return await asyncio.gather(
+            *(process_one(shot_list_path, semaphore)
+              for shot_list_path in valid_shot_list_paths))
+
+    successful_conversions = sum(asyncio.run(process_all()))
 
     logger.info(
         f"Conversion complete: {successful_conversions}/{total_files} files processed successfully")
@@ -230,31 +663,37 @@ def natural_sort_key(text):
     Returns:
         list: A list of elements (int or str) for natural sorting.
     """
-    def convert(substring):
-        if substring.isdigit():
-            return int(substring)
-        # Otherwise, convert to lowercase string for case-insensitive comparison
-        return substring.lower()
+    # Split the text into digit and non-digit parts; with a capture group
+    # the digit runs always land at odd indices, so no isdigit() check
+    parts = NATURAL_SORT_PATTERN.split(str(text))
+    # Numbers compare as ints, text case-insensitively
+    return [int(part) if index & 1 else part.lower()
+            for index, part in enumerate(parts)]
 
-    # Split the text into digit and non-digit parts using regex,
-    parts = re.split(r'(\d+)', str(text))
-    # then convert each part appropriately for sorting
-    return [convert(part) for part in parts]
 
+def sort_shot_list_paths(shot_list_paths):
+    """Return shot list paths in natural order of their file names.
 
-def process_combined_shot_lists(client, shot_list_paths, output_dir, combined_name):
-    """Combine multiple shot list files, generate image prompts, and save them."""
-    if not output_dir.exists():
-        output_dir.mkdir(parents=True, exist_ok=True)
-        logger.info(f"Created output directory: {output_dir}")
+    Each key is computed once and sorted alongside its path, so the sort
+    compares plain tuples without calling back into Python per item.
+    """
+    keyed_paths = [(natural_sort_key(path.name), index, path)
+                   for index, path in enumerate(shot_list_paths)]
+    keyed_paths.sort()
+    return [path for _, _, path in keyed_paths]
 
-    # Combine content from all shot list files, sorting them in natural order
-    full_shot_list_content = []
+
+def process_combined_shot_lists(client, shot_list_paths, output_dir, combined_name,
+                                characters_content="", use_cache=True):
+    """Combine multiple shot list files, generate image prompts, and save them."""
+    # Combine content from all shot list files, sorting them in natural order.
+    # Each file is written into one buffer as it is read, so the contents
+    # are not held both as a list of strings and as the joined result.
+    combined_buffer = io.StringIO()
     logger.info("Combining multiple shot list files into one.")
 
     # Sort files using natural sorting
-    sorted_shot_list_paths = sorted(
-        shot_list_paths, key=lambda x: natural_sort_key(x.name))
+    sorted_shot_list_paths = sort_shot_list_paths(shot_list_paths)
 
     logger.info("Shot list files will be combined in this order:")
     for i, shot_list_path in enumerate(sorted_shot_list_paths, 1):
@@ -263,20 +702,27 @@ def process_combined_shot_lists(client, shot_list_paths, output_dir, combined_na
     for shot_list_path in sorted_shot_list_paths:
         content = read_shot_list_file(shot_list_path)
         if content:
-            full_shot_list_content.append(content)
+            if combined_buffer.tell():
+                combined_buffer.write("\n\n")
+            combined_buffer.write(content)
         else:
             logger.warning(
                 f"Skipping empty or unreadable shot list: {shot_list_path}")
 
-    if not full_shot_list_content:
+    if not combined_buffer.tell():
         logger.error("No content found in shot list files to combine.")
         return
 
-    combined_content = "\n\n".join(full_shot_list_content)
+    combined_content = combined_buffer.getvalue()
+    combined_buffer.close()
 
     # Generate image prompts for the combined shot list
-    image_prompts = generate_image_prompts(
-        client, combined_content, f"{combined_name} (Combined)")
+    image_prompts = asyncio.run(generate_image_prompts_async(
+        client, combined_content, f"{combined_name} (Combined)", characters_content,
+        use_cache))
+    if image_prompts is None:
+        logger.error("Could not generate image prompts for the combined shot lists.")
+        return
 
     # Create output filename
     output_filename = f"{combined_name}_combined_image_prompts.txt"
@@ -289,14 +735,40 @@ def process_combined_shot_lists(client, shot_list_paths, output_dir, combined_na
     logger.info("Combined shot list processing complete.")
 
 
-def find_shot_list_files(directory):
-    """Find all .txt files in directory and subdirectories"""
+def scan_shot_list_files(directory, exclude_dir=None):
+    """Recursively collect .txt files under directory using os.scandir.
+
+    Hidden directories and exclude_dir (the output directory, whose
+    generated prompt files are not shot lists) are not descended into.
+    DirEntry objects carry the file type from the directory listing, so
+    only matching files are turned into Path objects.
+    """
+    txt_files = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name.startswith('.'):
+                        continue
+                    if exclude_dir is not None and Path(entry.path).resolve() == exclude_dir:
+                        continue
+                    txt_files.extend(scan_shot_list_files(entry.path, exclude_dir))
+                elif entry.name.lower().endswith('.txt') and entry.is_file():
+                    txt_files.append(Path(entry.path))
+    except OSError as e:
+        logger.warning(f"Could not scan directory {directory}: {e}")
+    return txt_files
+
+
+def find_shot_list_files(directory, exclude_dir=None):
+    """Find all .txt files in directory and subdirectories, skipping exclude_dir"""
     if directory.is_file() and directory.suffix.lower() == '.txt':
         return [directory]
 
     if directory.is_dir():
-        txt_files = list(directory.rglob('*.txt'))
-        return txt_files
+        if exclude_dir is not None:
+            exclude_dir = Path(exclude_dir).resolve()
+        return scan_shot_list_files(directory, exclude_dir)
 
     return []
 
@@ -319,6 +791,11 @@ def get_user_inputs():
             message="Output directory for image prompts",
             default="text_files/image_prompts"
         ),
+        inquirer.Confirm(
+            'use_cache',
+            message="Reuse cached Gemini responses for unchanged input?",
+            default=True
+        ),
         inquirer.Confirm(
             'verbose',
             message="Enable verbose logging?",
@@ -384,7 +861,10 @@ def main():
             sys.exit(1)
 
         # Find shot list files
-        shot_list_files = find_shot_list_files(input_path)
+        # Skip the output directory so earlier image prompts are not
+        # picked up as shot lists
+        shot_list_files = find_shot_list_files(
+            input_path, Path(inputs['output_dir']))
         if not shot_list_files:
             logger.error(f"No .txt shot list files found in: {input_path}")
             print(f"\nNo .txt shot list files found in: {input_path}")
@@ -412,9 +892,28 @@ def main():
             if answers['combine']:
                 combine_files = True
 
+        # Offer the cheaper, asynchronous batch API when processing separately
+        use_batch = False
+        if not combine_files and len(shot_list_files) >= BATCH_MIN_FILES:
+            batch_question = [
+                inquirer.Confirm(
+                    'use_batch',
+                    message="Submit as a Gemini batch job? (About half the cost, but can take minutes to hours)",
+                    default=False
+                )
+            ]
+            answers = inquirer.prompt(batch_question)
+            if not answers:
+                print("Operation cancelled.")
+                sys.exit(0)
+            use_batch = answers['use_batch']
+
         # Get API key if needed
         api_key = get_api_key_if_needed()
 
+        # Read character descriptions once for every request in this run
+        characters_content = read_characters_file()
+
         # Initialize Gemini client
         print("\n🔧 Initializing Gemini API client...")
         try:
@@ -427,26 +926,32 @@ def main():
         # Process files
         output_dir = Path(inputs['output_dir'])
 
-        # Create output directory if it doesn't exist
-        if not output_dir.exists():
-            try:
-                output_dir.mkdir(parents=True, exist_ok=True)
-                logger.info(f"Created output directory: {output_dir}")
-            except Exception as e:
-                logger.error(
-                    f"Failed to create output directory {output_dir}: {e}")
-                print(
-                    f"Error: Could not create output directory {output_dir}: {e}")
-                sys.exit(1)
-
-        if combine_files:
-            print(f"\nCombining shot lists and generating image prompts...")
-            combined_name = input_path.name
-            process_combined_shot_lists(
-                client, shot_list_files, output_dir, combined_name)
-        else:
-            print(f"\nProcessing shot list files individually...")
-            process_shot_list_files(client, shot_list_files, output_dir)
+        # Create output directory if it doesn't exist; the processing
+        # functions below assume it is already there
+        try:
+            output_dir.mkdir(parents=True, exist_ok=True)
+        except Exception as e:
+            logger.error(
+                f"Failed to create output directory {output_dir}: {e}")
+            print(
+                f"Error: Could not create output directory {output_dir}: {e}")
+            sys.exit(1)
+
+        try:
+            if combine_files:
+                print(f"\nCombining shot lists and generating image prompts...")
+                combined_name = input_path.name
+                process_combined_shot_lists(
+                    client, shot_list_files, output_dir, combined_name,
+                    characters_content, inputs['use_cache'])
+            else:
+                print(f"\nProcessing shot list files individually...")
+                process_shot_list_files(
+                    client, shot_list_files, output_dir, characters_content, use_batch,
+                    inputs['use_cache'])
+        finally:
+            # Cached content is billed for storage until it expires
+            delete_prompt_cache(client)
 
         print(f"\nImage prompts saved to: {output_dir.absolute()}")
 
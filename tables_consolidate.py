@@ -1,8 +1,35 @@
+import importlib.util
+import os
 import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import pandas as pd
 import inquirer
 from pathlib import Path
 
+# Splits file names into digit and non-digit runs for natural sorting
+NATURAL_SORT_PATTERN = re.compile(r'(\d+)')
+
+# CSV files are parsed with pyarrow's multithreaded C++ reader when the
+# optional pyarrow package is installed, and with pandas' C parser otherwise
+CSV_ENGINE = 'pyarrow' if importlib.util.find_spec('pyarrow') else 'c'
+
+# Runs with fewer CSV files than this are parsed in-process; each worker
+# process re-imports pandas and pickles its DataFrame back, which costs more
+# than it saves for a handful of tables
+MIN_FILES_FOR_PROCESS_POOL = 8
+
+# pyarrow already parses each file on a thread pool sized to the machine,
+# so only a few worker processes are used with it to avoid oversubscribing
+# the cores
+MAX_READ_WORKERS = (max(1, (os.cpu_count() or 1) // 4) if CSV_ENGINE == 'pyarrow'
+                    else os.cpu_count() or 1)
+
+# Maximum number of CSV files parsed ahead of the writer, so worker
+# processes stay busy without every file's rows piling up in memory
+MAX_PENDING_READS = 2 * MAX_READ_WORKERS
+
 
 def natural_sort_key(text):
     """
@@ -19,19 +46,62 @@ def natural_sort_key(text):
     Returns:
         list: A list of elements (int or str) for natural sorting.
     """
-    def convert(substring):
-        if substring.isdigit():
-            return int(substring)
-        # Otherwise, convert to lowercase string for case-insensitive comparison
-        return substring.lower()
+    # Split the text into digit and non-digit parts; with a capture group
+    # the digit runs always land at odd indices, so no isdigit() check
+    parts = NATURAL_SORT_PATTERN.split(str(text))
+    # Numbers compare as ints, text case-insensitively
+    return [int(part) if index & 1 else part.lower()
+            for index, part in enumerate(parts)]
+
+
+def sort_csv_paths(csv_files):
+    """Return CSV paths in natural order of their file names.
+
+    Each key is computed once and sorted alongside its path, so the sort
+    compares plain tuples without calling back into Python per item.
+    """
+    keyed_paths = [(natural_sort_key(path.name), index, path)
+                   for index, path in enumerate(csv_files)]
+    keyed_paths.sort()
+    return [path for _, _, path in keyed_paths]
+
 
-    # Split the text into digit and non-digit parts using regex,
-    parts = re.split(r'(\d+)', str(text))
-    # then convert each part appropriately for sorting
-    return [convert(part) for part in parts]
+def read_csv_file(file_path):
+    """Read one CSV file into a DataFrame (may run in a worker process)"""
+    if CSV_ENGINE == 'pyarrow':
+        # pyarrow is called directly because pandas' pyarrow engine does not
+        # allow quoted newlines, and image prompts can span several lines
+        from pyarrow import csv as pa_csv
 
+        parse_options = pa_csv.ParseOptions(newlines_in_values=True)
+        return pa_csv.read_csv(file_path, parse_options=parse_options).to_pandas()
+    return pd.read_csv(file_path, engine=CSV_ENGINE)
 
-def consolidate_csv_files(input_directory, output_file=None):
+
+def iter_csv_reads(csv_files):
+    """Yield (path, read) pairs in input order; read() returns the file's DataFrame.
+
+    Fewer than MIN_FILES_FOR_PROCESS_POOL files are parsed in-process when
+    read() is called. Larger runs are parsed in worker processes, with at
+    most MAX_PENDING_READS files submitted ahead of the consumer.
+    """
+    if len(csv_files) < MIN_FILES_FOR_PROCESS_POOL:
+        for file_path in csv_files:
+            yield file_path, partial(read_csv_file, file_path)
+        return
+
+    max_workers = min(len(csv_files), MAX_READ_WORKERS)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for file_path in csv_files:
+            pending.append((file_path, executor.submit(read_csv_file, file_path).result))
+            if len(pending) >= MAX_PENDING_READS:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+
+
+def consolidate_csv_files(input_directory, output_file=None, csv_files=None):
     """
     Consolidate multiple CSV files from a directory into a single CSV file.
 
@@ -41,6 +111,7 @@ def consolidate_csv_files(input_directory, output_file=None):
     Args:
         input_directory (str): Path to directory containing CSV files
         output_file (str, optional): Path for output CSV file. If None, saves as 'consolidated.csv' in input directory
+        csv_files (list, optional): CSV file paths already found in input_directory. If None, the directory is globbed
 
     Returns:
         str: Path to the consolidated CSV file
@@ -51,68 +122,98 @@ def consolidate_csv_files(input_directory, output_file=None):
         raise FileNotFoundError(
             f"Input directory '{input_directory}' does not exist")
 
-    # Find all CSV files in the directory
-    csv_files = list(input_path.glob("*.csv"))
+    # Find all CSV files in the directory, unless the caller already has
+    if csv_files is None:
+        csv_files = list(input_path.glob("*.csv"))
+    else:
+        csv_files = list(csv_files)
 
     if not csv_files:
         raise ValueError(
             f"No CSV files found in directory '{input_directory}'")
 
+    # Determine output file path
+    if output_file is None:
+        output_file = input_path / "consolidated.csv"
+    else:
+        output_file = Path(output_file)
+
+    # The output is written while inputs are read, so a previous output in
+    # the same directory must not be read back in as an input
+    resolved_output = output_file.resolve()
+    csv_files = [f for f in csv_files if f.resolve() != resolved_output]
+    if not csv_files:
+        raise ValueError(
+            f"No CSV files found in directory '{input_directory}'")
+
     # Sort files using natural/alphanumeric ordering
-    csv_files.sort(key=lambda x: natural_sort_key(x.name))
+    csv_files = sort_csv_paths(csv_files)
 
     print(f"Found {len(csv_files)} CSV files:")
     for i, file in enumerate(csv_files, 1):
         print(f"  {i}. {file.name}")
 
-    # List to store all dataframes
-    dataframes = []
     columns = None
-
-    # Process each CSV file
-    for file_path in csv_files:
-        try:
-            print(f"Processing: {file_path.name}")
-            df = pd.read_csv(file_path)
-
-            # Set columns from first file (dynamic column detection)
-            if columns is None:
-                columns = df.columns.tolist()
-                print(f"Detected columns: {columns}")
-
-            # Ensure all files have the same columns
-            if not df.columns.tolist() == columns:
-                print(
-                    f"Warning: {file_path.name} has different columns. Attempting to align...")
-                # Reindex to match expected columns, filling missing columns with NaN
-                df = df.reindex(columns=columns)
-
-            dataframes.append(df)
-
-        except Exception as e:
-            print(f"Error processing {file_path.name}: {e}")
-            continue
-
-    if not dataframes:
-        raise ValueError("No valid CSV files could be processed")
-
-    # Concatenate all dataframes
-    print("Consolidating data...")
-    consolidated_df = pd.concat(dataframes, ignore_index=True)
-
-    # Determine output file path
-    if output_file is None:
-        output_file = input_path / "consolidated.csv"
-    else:
-        output_file = Path(output_file)
-
-    # Save consolidated CSV
-    consolidated_df.to_csv(output_file, index=False)
+    columns_tuple = None
+    columns_set = None
+    processed_files = 0
+    total_rows = 0
+
+    # Rows are appended to the output as each file is read, so only one
+    # file's data is in memory at a time. A temporary file is renamed into
+    # place at the end, so a failed run never leaves a partial output.
+    tmp_output_file = output_file.with_name(output_file.name + ".tmp")
+    try:
+        with open(tmp_output_file, 'w', encoding='utf-8', newline='') as out:
+            # Process each CSV file; for larger runs parsing happens in
+            # parallel worker processes while rows are written here in the
+            # original order
+            for file_path, read_csv in iter_csv_reads(csv_files):
+                try:
+                    print(f"Processing: {file_path.name}")
+                    df = read_csv()
+
+                    # Set columns from first file (dynamic column detection)
+                    if columns is None:
+                        columns = df.columns.tolist()
+                        columns_tuple = tuple(columns)
+                        columns_set = frozenset(columns)
+                        print(f"Detected columns: {columns}")
+
+                    # Ensure all files have the same columns. Matching columns
+                    # (the common case) need no work; the same columns in
+                    # another order only need a reorder, not a reindex.
+                    file_columns = tuple(df.columns)
+                    if file_columns == columns_tuple:
+                        pass
+                    elif frozenset(file_columns) == columns_set:
+                        df = df[columns]
+                    else:
+                        print(
+                            f"Warning: {file_path.name} has different columns. Attempting to align...")
+                        # Reindex to match expected columns, filling missing columns with NaN
+                        df = df.reindex(columns=columns)
+
+                    # The header comes from the first file only
+                    df.to_csv(out, header=processed_files == 0, index=False)
+                    processed_files += 1
+                    total_rows += len(df)
+
+                except Exception as e:
+                    print(f"Error processing {file_path.name}: {e}")
+                    continue
+
+        if not processed_files:
+            raise ValueError("No valid CSV files could be processed")
+
+        os.replace(tmp_output_file, output_file)
+    finally:
+        tmp_output_file.unlink(missing_ok=True)
 
     print(
-        f"Successfully consolidated {len(dataframes)} files into '{output_file}'")
-    print(f"Total rows: {len(consolidated_df)}")
-    print(f"Columns: {consolidated_df.columns.tolist()}")
+        f"Successfully consolidated {processed_files} files into '{output_file}'")
+    print(f"Total rows: {total_rows}")
+    print(f"Columns: {columns}")
 
     return str(output_file)
 
@@ -196,7 +297,7 @@ def main():
     # Perform consolidation
     try:
         print("\nStarting consolidation...")
-        output_path = consolidate_csv_files(input_directory, output_file)
+        output_path = consolidate_csv_files(input_directory, output_file, csv_files)
         print(f"\nConsolidation complete! Output saved to: {output_path}")
     except Exception as e:
         print(f"Error: {e}")
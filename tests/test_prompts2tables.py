@@ -0,0 +1,23 @@
+import unittest
+
+try:
+    from pydantic import TypeAdapter
+    import google.genai  # noqa: F401
+except ImportError:
+    TypeAdapter = None
+
+import prompts2tables
+
+
+@unittest.skipIf(TypeAdapter is None, "google-genai is not installed")
+class BuildGenerationConfigTest(unittest.TestCase):
+    def test_response_schema_builds(self):
+        # pydantic only accepts typing_extensions.TypedDict before Python 3.12,
+        # and the SDK builds this schema before sending any request
+        config = prompts2tables.build_generation_config()
+        schema = TypeAdapter(config.response_schema).json_schema()
+        self.assertEqual(schema['type'], 'array')
+
+
+if __name__ == '__main__':
+    unittest.main()
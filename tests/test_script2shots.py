@@ -0,0 +1,23 @@
+import unittest
+
+try:
+    import script2shots
+except ImportError:
+    script2shots = None
+
+
+@unittest.skipIf(script2shots is None, "project dependencies are not installed")
+class EstimateTokensTest(unittest.TestCase):
+    def test_ascii_text(self):
+        self.assertEqual(script2shots.estimate_tokens("a" * 400), 100)
+
+    def test_cjk_text_counts_a_token_per_character(self):
+        # 4 characters per token would let a 2048-token CJK script past
+        # EMBEDDING_MAX_TOKENS at four times the limit
+        text = "夜の街" * 1000
+        self.assertEqual(script2shots.estimate_tokens(text), 3000)
+        self.assertGreater(script2shots.estimate_tokens(text), script2shots.EMBEDDING_MAX_TOKENS)
+
+
+if __name__ == '__main__':
+    unittest.main()
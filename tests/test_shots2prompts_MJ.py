@@ -0,0 +1,27 @@
+import unittest
+
+try:
+    import shots2prompts_MJ
+except ImportError:
+    shots2prompts_MJ = None
+
+
+@unittest.skipIf(shots2prompts_MJ is None, "project dependencies are not installed")
+class SanitizeImagePromptsTest(unittest.TestCase):
+    def test_strips_sref_inside_quoted_prompt(self):
+        text = '1. "A rainy street at night --ar 16:9 --v 7 --sref 123456"'
+        self.assertEqual(shots2prompts_MJ.sanitize_image_prompts(text),
+                         '1. "A rainy street at night --ar 16:9 --v 7"')
+
+    def test_strips_bare_trailing_sref(self):
+        text = 'A rainy street at night --v 7 --sref\nNext prompt --sref 1 2 --s 50'
+        self.assertEqual(shots2prompts_MJ.sanitize_image_prompts(text),
+                         'A rainy street at night --v 7\nNext prompt --s 50')
+
+    def test_caps_stylize(self):
+        self.assertEqual(shots2prompts_MJ.sanitize_image_prompts('A field --stylize 750'),
+                         'A field --stylize 200')
+
+
+if __name__ == '__main__':
+    unittest.main()